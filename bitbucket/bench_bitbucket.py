@@ -0,0 +1,159 @@
+'''
+Benchmark of the permissions report: thread version (BitbucketGetter from
+"bitbucket_get_permissions 2.py") against the asyncio version
+(bitbucket_async.AsyncBitbucketGetter), both run against a local mock of the
+Bitbucket API that adds a fixed latency to every response and to every new
+connection (TCP + TLS handshake).
+Usage: python bench_bitbucket.py --repos 500 --latency 50 --handshake 100 --threads 30 --concurrency 20
+'''
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import bitbucket_async
+
+WORKSPACE = 'bench'
+USER = 'owner'
+
+
+def load_thread_version():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bitbucket_get_permissions 2.py')
+    spec = importlib.util.spec_from_file_location('bitbucket_get_permissions', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class MockBitbucket(BaseHTTPRequestHandler):
+    # Answers the endpoints used by the report, the data is built from the server settings
+    protocol_version = 'HTTP/1.1'
+    #headers and body in one write, otherwise Nagle + delayed ACK stall every keep-alive response
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        #cost of the TCP + TLS handshake of a new connection, paid once per keep-alive connection
+        time.sleep(self.server.handshake)
+        super().setup()
+
+    def body(self, url):
+        parts = [part for part in url.path.split('/') if part]
+        repos, pagelen = self.server.repos, self.server.pagelen
+        if parts[1:] == ['user']:
+            return {'nickname': USER}
+        if parts[1:] == ['workspaces']:
+            return {'values': [{'slug': WORKSPACE}]}
+        if parts[1] == 'workspaces':
+            return {'values': [{'user': {'nickname': USER}}]}
+        if parts[1] == 'repositories':
+            page = int(parse_qs(url.query).get('page', ['1'])[0])
+            values = [{'slug': f'repo-{i}', 'project': {'key': f'P{i % 10}', 'name': f'Project {i % 10}'}}
+                      for i in range((page - 1) * pagelen, min(page * pagelen, repos))]
+            body = {'size': repos, 'pagelen': pagelen, 'page': page, 'values': values}
+            if page * pagelen < repos:
+                body['next'] = f'{self.server.base_url}/2.0/repositories/{WORKSPACE}?page={page + 1}'
+            return body
+        if parts[1] == 'teams':
+            repo = parts[-1]
+            return {'values': [{'user': {'nickname': f'user-{j}'}, 'repository': {'full_name': f'{WORKSPACE}/{repo}'},
+                                'permission': 'write'} for j in range(self.server.users)]}
+        if parts[1] == 'group-privileges':
+            return [{'group': {'slug': 'developers', 'members': [{'nickname': f'user-{j}'} for j in range(self.server.users)]}}]
+        return None
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = self.body(urlparse(self.path))
+        with self.server.requests.get_lock():
+            self.server.requests.value += 1
+        data = json.dumps(body).encode()
+        self.send_response(200 if body is not None else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockServer(ThreadingHTTPServer):
+    #the default backlog of 5 drops the SYNs of concurrent clients, which then wait 1s to retry
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def serve(repos, pagelen, users, latency, handshake, requests, address):
+    server = MockServer(('127.0.0.1', 0), MockBitbucket)
+    server.repos, server.pagelen, server.users, server.latency = repos, pagelen, users, latency
+    server.handshake = handshake
+    server.requests = requests
+    server.base_url = f'http://127.0.0.1:{server.server_port}'
+    address.put(server.base_url)
+    server.serve_forever()
+
+
+def start_server(repos, pagelen, users, latency, handshake):
+    # The mock runs in its own process, in the benchmark process its threads would
+    # compete for the GIL with the clients being measured
+    requests = multiprocessing.Value('i', 0)
+    address = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(repos, pagelen, users, latency, handshake, requests, address), daemon=True)
+    process.start()
+    return process, address.get(), requests
+
+
+def run(name, requests, report):
+    requests.value = 0
+    start = time.perf_counter()
+    perms = report()
+    seconds = time.perf_counter() - start
+    rows = sum(len(rows) for rows in perms.values())
+    print(f"{name:<8} {rows:>8} rows {requests.value:>6} requests {seconds:>8.2f}s {requests.value / seconds:>9.1f} req/s")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Thread vs asyncio permissions report against a mock Bitbucket API')
+    parser.add_argument("--repos", type=int, default=500, help="Repositories in the mock workspace")
+    parser.add_argument("--pagelen", type=int, default=10, help="Repositories per page")
+    parser.add_argument("--users", type=int, default=5, help="Users with access to every repository")
+    parser.add_argument("--latency", type=float, default=50, help="Latency added to every response, in ms")
+    parser.add_argument("--handshake", type=float, default=100, help="Latency added to every new connection, in ms")
+    parser.add_argument("--threads", type=int, default=30, help="Threads of generate_report_multithread")
+    parser.add_argument("--concurrency", type=int, default=bitbucket_async.CONCURRENCY, help="Requests in flight of the asyncio version")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    process, address, requests = start_server(args.repos, args.pagelen, args.users, args.latency / 1000,
+                                               args.handshake / 1000)
+    base_url, old_base_url = f'{address}/2.0', f'{address}/1.0'
+    thread_version = load_thread_version()
+
+    def threads():
+        getter = thread_version.BitbucketGetter('key', 'secret', base_url=base_url, old_base_url=old_base_url)
+        return getter.generate_report_multithread(save_report=False, n_threads=args.threads)
+
+    def asyncio_version():
+        #the mock server is plain HTTP, so HTTP/1.1 keep-alive is measured
+        return asyncio.run(bitbucket_async.generate_report('key', 'secret', save_report=False, concurrency=args.concurrency,
+                                                           base_url=base_url, old_base_url=old_base_url))
+
+    print(f"{args.repos} repositories, {args.pagelen} per page, {args.latency:.0f} ms latency, "
+          f"{args.handshake:.0f} ms per new connection")
+    thread_seconds = run('threads', requests, threads)
+    async_seconds = run('asyncio', requests, asyncio_version)
+    print(f"speedup: {thread_seconds / async_seconds:.1f}x")
+    process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import asyncio
+import importlib.util
+import logging
+import math
+from collections import defaultdict
+
+import httpx
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                    datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
+
+# HTTP/2 needs the h2 package (pip install httpx[http2]), HTTP/1.1 keep-alive is used otherwise
+HTTP2 = importlib.util.find_spec('h2') is not None
+# Requests in flight. Over HTTP/1.1 every one holds a connection and the httpx pool
+# gets CPU bound past ~30 connections, over HTTP/2 they share one connection.
+CONCURRENCY = 30
+
+
+class AsyncBitbucketGetter:
+    """asyncio version of BitbucketGetter (bitbucket_get_permissions 2.py).
+
+    Every request goes through one httpx.AsyncClient, so TCP/TLS connections are
+    kept alive and reused, and a semaphore bounds the requests in flight. The
+    permissions and the group privileges of each repository are requested
+    concurrently, and they are requested as soon as the page listing the
+    repository lands (the pages after the first one are fetched concurrently).
+    """
+
+    def __init__(self, key, secret, refresh_token=None, concurrency=CONCURRENCY, http2=HTTP2,
+                 base_url='https://api.bitbucket.org/2.0', old_base_url='https://api.bitbucket.org/1.0',
+                 token_url='https://bitbucket.org/site/oauth2/access_token'):
+        self.key = key
+        self.secret = secret
+        self.refresh_token = refresh_token
+        self.logger = logging
+        self.logger.info('Starting AsyncBitbucketGetter')
+        self.base_url = base_url
+        self.old_base_url = old_base_url
+        self.token_url = token_url
+        self.concurrency = concurrency
+        self.http2 = http2
+        self.requests = 0
+        self.perms_dict = defaultdict(list)
+
+    async def __aenter__(self):
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        self.client = httpx.AsyncClient(http2=self.http2, limits=limits, timeout=30)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        if self.refresh_token:
+            self.client.headers['Authorization'] = f'Bearer {await self.get_access_token()}'
+        else:
+            self.client.auth = (self.key, self.secret)
+        self.current_user = (await self.execute_query('user'))['nickname']
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    async def execute_query(self, resource, query='', page='', old_api=False):
+        base_url = self.base_url if not old_api else self.old_base_url
+        url = f'{base_url}/{resource}/{query}{page}'
+        async with self.semaphore:
+            self.requests += 1
+            try:
+                response = await self.client.get(url)
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPError:
+                self.logger.info('Check your access details')
+                raise
+
+    async def get_access_token(self):
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': self.refresh_token
+        }
+        response = await self.client.post(self.token_url, data=data, auth=(self.key, self.secret))
+        return response.json()['access_token']
+
+    async def get_workspaces(self, response_workspace, res_type='slug'):
+        owners = await asyncio.gather(*(self.get_workspace_owners(i[res_type]) for i in response_workspace))
+        return [i[res_type] for i, workspace_owners in zip(response_workspace, owners) if self.current_user in workspace_owners]
+
+    async def get_workspace_owners(self, workspace):
+        response = await self.execute_query('workspaces', f'{workspace}/members?q=permission="owner"')
+        return [i['user']['nickname'] for i in response['values']]
+
+    async def get_repositories(self, workspace, res_type='slug', limit_page=999, on_page=None):
+        # Reads size and pagelen from the first page and fetches the remaining pages
+        # concurrently, on_page is called with the repositories of every page as it lands
+        page = 1
+        self.logger.info(f"Getting repositories from page {page}")
+        current_repos = await self.execute_query('repositories', workspace, page=f"?page={page}")
+        repos_pages = {page: current_repos}
+        self._page_landed(current_repos, res_type, on_page)
+        if 'size' in current_repos and current_repos.get('pagelen'):
+            last_page = min(math.ceil(current_repos['size'] / current_repos['pagelen']), limit_page + 1)
+            self.logger.info(f"Getting repositories from pages 2 to {last_page}")
+
+            async def fetch(page):
+                return page, await self.execute_query('repositories', workspace, page=f"?page={page}")
+
+            for future in asyncio.as_completed([fetch(page) for page in range(2, last_page + 1)]):
+                page, repos_page = await future
+                repos_pages[page] = repos_page
+                self._page_landed(repos_page, res_type, on_page)
+        else:
+            # size is optional in the API, walk the pages one at a time
+            while current_repos.get('next', None) and page <= limit_page:
+                page += 1
+                self.logger.info(f"Getting repositories from page {page}")
+                current_repos = await self.execute_query('repositories', workspace, page=f"?page={page}")
+                repos_pages[page] = current_repos
+                self._page_landed(current_repos, res_type, on_page)
+
+        return [repo for page in sorted(repos_pages) for repo in self._page_repos(repos_pages[page], res_type)]
+
+    def _page_repos(self, repos_page, res_type='slug'):
+        return [(i[res_type], i['project']['key'], i['project']['name']) for i in repos_page['values']]
+
+    def _page_landed(self, repos_page, res_type, on_page):
+        if on_page:
+            on_page(self._page_repos(repos_page, res_type))
+
+    async def get_repo_permissions(self, workspace, repo):
+        # According to bitbucket.com api description 'teams' resource is depcrecated
+        # this may no work in a near future
+        self.logger.debug(f'Getting permissions for each user from repository: {repo}')
+        return (await self.execute_query('teams', f'{workspace}/permissions/repositories/{repo}'))['values']
+
+    async def get_group_members(self, workspace, repo):
+        # Returns {'member_nickname': 'group_name'}
+        self.logger.debug(f'Getting groups for each repo {repo} members')
+        groups = await self.execute_query('group-privileges', f'{workspace}/{repo}', old_api=True)
+        res = {}
+        for group in groups:
+            group = group['group']
+            for member in group['members']:
+                res[member['nickname']] = group['slug']
+
+        return res
+
+    async def get_permissions(self, workspace, repo):
+        repo, project_key, project_name = repo
+        res, users_group = await asyncio.gather(self.get_repo_permissions(workspace, repo),
+                                                self.get_group_members(workspace, repo))
+        for user in res:
+            nick = user['user']['nickname']
+            self.perms_dict[workspace].append(
+                {
+                    'user_name': nick,
+                    'user_nickname': user['user']['nickname'],
+                    'project_key': project_key,
+                    'project_name': project_name,
+                    'repo': repo,
+                    'repo_full_name': user['repository']['full_name'],
+                    'group': users_group.get(nick, 'No group'),
+                    'permission': user['permission']
+                }
+            )
+
+    async def process_workspace(self, workspace):
+        self.logger.info(f"Processing workspace: {workspace}")
+        # Permissions are requested as soon as the page of a repository lands
+        tasks = []
+        await self.get_repositories(workspace, on_page=lambda repos: tasks.extend(
+            asyncio.ensure_future(self.get_permissions(workspace, repo)) for repo in repos))
+        await asyncio.gather(*tasks)
+
+    def save_report(self, perms_dict, format_='csv'):
+        import pandas as pd
+        self.logger.info(f'Saving report in {format_} format')
+
+        for workspace, data in perms_dict.items():
+            if format_ == 'csv':
+                pd.DataFrame(data).to_csv(f'{workspace}.csv', index=False)
+            else:
+                pd.DataFrame(data).to_excel(f'{workspace}.xlsx', index=False)
+
+    async def generate_report(self, save_report=True, format_='csv'):
+        self.logger.info(f'Generating async report (http2={self.http2}, concurrency={self.concurrency})..')
+        workspaces = await self.get_workspaces((await self.execute_query('workspaces'))['values'])
+        await asyncio.gather(*(self.process_workspace(workspace) for workspace in workspaces))
+
+        if save_report:
+            self.save_report(self.perms_dict, format_=format_)
+
+        return self.perms_dict
+
+
+async def generate_report(key, secret, refresh_token=None, save_report=True, format_='csv', **kwargs):
+    async with AsyncBitbucketGetter(key, secret, refresh_token, **kwargs) as getter:
+        return await getter.generate_report(save_report=save_report, format_=format_)
+
+
+if __name__ == "__main__":
+    key = ''  # USERNAME
+    secret = '' # PASS
+    asyncio.run(generate_report(key, secret, format_='excel'))
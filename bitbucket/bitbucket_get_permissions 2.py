@@ -1,7 +1,9 @@
 import requests
 import pandas as pd
 import logging
+import math
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from queue import Queue
 from  collections import defaultdict
 
@@ -10,14 +12,15 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
 
 
 class BitbucketGetter:
-    def __init__(self, key, secret, refresh_token=None):
+    def __init__(self, key, secret, refresh_token=None, base_url='https://api.bitbucket.org/2.0',
+                 old_base_url='https://api.bitbucket.org/1.0'):
         self.key = key
         self.secret = secret
         self.refresh_token = refresh_token
         self.logger = logging
         self.logger.info('Starting BitbucketGetter')
-        self.base_url = 'https://api.bitbucket.org/2.0'
-        self.old_base_url = 'https://api.bitbucket.org/1.0'
+        self.base_url = base_url
+        self.old_base_url = old_base_url
         self.threaded_perms_dict = defaultdict(list)
         if refresh_token:
             self.headers = {
@@ -57,20 +60,46 @@ class BitbucketGetter:
     def get_workspace_owners(self, workspace):
         return [i['user']['nickname'] for i in self.execute_query('workspaces', f'{workspace}/members?q=permission="owner"')['values']]
 
-    def get_repositories(self, workspace, res_type='slug', limit_page=999):
+    def get_repositories(self, workspace, res_type='slug', limit_page=999, on_page=None, n_threads=10):
+        """Returns the (repo, project key, project name) of the workspace.
+
+        The first page tells the number of repositories (size) and the page length,
+        the remaining pages are then fetched concurrently. on_page, if given, is
+        called with the repositories of every page as soon as it lands, so the
+        caller can start working on them while the listing goes on.
+        """
         page = 1
         self.logger.info(f"Getting repositories from page {page}")
         current_repos = self.execute_query(
             'repositories', workspace, page=f"?page={page}")
-        repos_pages = [current_repos]
-        while current_repos.get('next', None) and page <= limit_page:
-            page -=- 1
-            self.logger.info(f"Getting repositories from page {page}")
-            current_repos = self.execute_query('repositories', workspace, page=f"?page={page}")
-            repos_pages.append(current_repos)
+        repos_pages = {page: current_repos}
+        self._page_landed(current_repos, res_type, on_page)
+        if 'size' in current_repos and current_repos.get('pagelen'):
+            last_page = min(math.ceil(current_repos['size'] / current_repos['pagelen']), limit_page + 1)
+            self.logger.info(f"Getting repositories from pages 2 to {last_page}")
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                futures = {pool.submit(self.execute_query, 'repositories', workspace, page=f"?page={page}"): page
+                           for page in range(2, last_page + 1)}
+                for future in as_completed(futures):
+                    repos_pages[futures[future]] = future.result()
+                    self._page_landed(repos_pages[futures[future]], res_type, on_page)
+        else:
+            # size is optional in the API, walk the pages one at a time
+            while current_repos.get('next', None) and page <= limit_page:
+                page -=- 1
+                self.logger.info(f"Getting repositories from page {page}")
+                current_repos = self.execute_query('repositories', workspace, page=f"?page={page}")
+                repos_pages[page] = current_repos
+                self._page_landed(current_repos, res_type, on_page)
+
+        return [repo for page in sorted(repos_pages) for repo in self._page_repos(repos_pages[page], res_type)]
 
-        return [(i[res_type], i['project']['key'], i['project']['name'])
-                for repos_page in repos_pages for i in repos_page['values']]
+    def _page_repos(self, repos_page, res_type='slug'):
+        return [(i[res_type], i['project']['key'], i['project']['name']) for i in repos_page['values']]
+
+    def _page_landed(self, repos_page, res_type, on_page):
+        if on_page:
+            on_page(self._page_repos(repos_page, res_type))
 
     def get_permissions(self, workspace, repos):
         self.logger.info(f"Processing workspace: {workspace}")
@@ -189,9 +218,9 @@ class BitbucketGetter:
 
         workspaces = self.get_workspaces(self.execute_query('workspaces')['values'])
         for workspace in workspaces:
-            repos = self.get_repositories(workspace)
-            for repo in repos:
-                self.request_queue.put((workspace, repo))
+            # Repositories are queued as their page lands, the threads start on them while the listing goes on
+            self.get_repositories(workspace, on_page=lambda repos, workspace=workspace: [
+                self.request_queue.put((workspace, repo)) for repo in repos])
         
         self.request_queue.join()
 
@@ -0,0 +1,149 @@
+'''
+----------------------------------------------------------------------------------
+Multi-account helpers: STS AssumeRole with a credential cache and a client pool.
+Credentials are kept per role until shortly before they expire, so a sweep over
+hundreds of accounts calls STS once per account instead of once per client, and
+clients are reused per (role, region, service).
+Used by the EC2 scanner (scan_engine.py) and the Config rule (test2.py).
+----------------------------------------------------------------------------------
+'''
+
+import datetime
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+ROLE_NAME = 'OrganizationAccountAccessRole'
+SESSION_NAME = 'ec2ComplianceScan'
+DURATION_SECONDS = 3600
+#Credentials closer than this to their expiration are renewed
+REFRESH_MARGIN_SECONDS = 300
+MAX_WORKERS = 16
+
+
+def role_arn(account_id, role_name=ROLE_NAME):
+    return f'arn:aws:iam::{account_id}:role/{role_name}'
+
+
+def parse_accounts(accounts):
+    """Splits a comma separated --accounts value into a list of account ids."""
+    return [account.strip() for account in accounts.split(',') if account.strip()]
+
+
+_sts_clients = {}
+_sts_lock = threading.Lock()
+
+
+def get_sts_client(region=None):
+    """STS client shared by the fetcher threads, created once per region in its own session
+    (clients are thread safe, the default boto3 session is not)."""
+    with _sts_lock:
+        if region not in _sts_clients:
+            _sts_clients[region] = boto3.session.Session().client('sts', region_name=region)
+        return _sts_clients[region]
+
+
+def assume_role(role_arn, region=None):
+    """Default credential fetcher, returns the Credentials dict of sts.assume_role."""
+    sts_client = get_sts_client(region)
+    response = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=SESSION_NAME,
+                                      DurationSeconds=DURATION_SECONDS)
+    return response['Credentials']
+
+
+def is_expiring(credentials, margin=REFRESH_MARGIN_SECONDS):
+    expiration = credentials['Expiration']
+    if isinstance(expiration, str):
+        expiration = datetime.datetime.fromisoformat(expiration.replace('Z', '+00:00'))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return expiration - now < datetime.timedelta(seconds=margin)
+
+
+class CredentialCache:
+
+    def __init__(self, fetch=assume_role, refresh_margin=REFRESH_MARGIN_SECONDS):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.credentials = {}
+        self.sts_calls = 0
+        self.lock = threading.Lock()
+        #one lock per role, concurrent callers of the same role wait for a single AssumeRole
+        self.role_locks = defaultdict(threading.Lock)
+
+    def get(self, role_arn, region=None):
+        """Returns cached credentials for role_arn, assuming the role when missing or expiring."""
+        with self.lock:
+            role_lock = self.role_locks[role_arn]
+        with role_lock:
+            credentials = self.credentials.get(role_arn)
+            if credentials is None or is_expiring(credentials, self.refresh_margin):
+                credentials = self.fetch(role_arn, region)
+                self.credentials[role_arn] = credentials
+                self.sts_calls += 1
+            return credentials
+
+    def prefetch(self, role_arns, region=None, max_workers=MAX_WORKERS):
+        """Assumes every role concurrently, returns {role_arn: error} for the ones that failed."""
+        def fetch(role_arn):
+            try:
+                self.get(role_arn, region)
+            except Exception as e:
+                return e
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            errors = dict(zip(role_arns, pool.map(fetch, role_arns)))
+        return {role_arn: error for role_arn, error in errors.items() if error}
+
+
+def session_from_credentials(credentials):
+    return boto3.session.Session(aws_access_key_id=credentials['AccessKeyId'],
+                                 aws_secret_access_key=credentials['SecretAccessKey'],
+                                 aws_session_token=credentials['SessionToken'])
+
+
+class ClientPool:
+    """Clients and resources reused per (role_arn, region, service), rebuilt when the
+    credentials of their role were renewed. Without role_arn the default credentials
+    are used. Every client or resource is built from its own session, the default
+    boto3 session is not thread safe."""
+
+    def __init__(self, credential_cache=None, config=None):
+        self.credential_cache = credential_cache or CredentialCache()
+        self.config = config
+        self.clients = {}
+        self.lock = threading.Lock()
+        #resources are not thread safe, every thread keeps its own
+        self.local = threading.local()
+
+    def _session(self, credentials):
+        return session_from_credentials(credentials) if credentials else boto3.session.Session()
+
+    def get_client(self, service, role_arn=None, region=None):
+        """Returns a client shared by all the threads (clients are thread safe)."""
+        credentials = self.credential_cache.get(role_arn, region) if role_arn else None
+        key = (role_arn, region, service)
+        with self.lock:
+            cached = self.clients.get(key)
+            if cached and cached[0] is credentials:
+                return cached[1]
+            client = self._session(credentials).client(service, region_name=region, config=self.config)
+            self.clients[key] = (credentials, client)
+            return client
+
+    def get_resource(self, service, role_arn=None, region=None):
+        """Returns a resource of the current thread."""
+        credentials = self.credential_cache.get(role_arn, region) if role_arn else None
+        if not hasattr(self.local, 'resources'):
+            self.local.resources = {}
+        key = (role_arn, region, service)
+        cached = self.local.resources.get(key)
+        if cached and cached[0] is credentials:
+            return cached[1]
+        resource = self._session(credentials).resource(service, region_name=region, config=self.config)
+        self.local.resources[key] = (credentials, resource)
+        return resource
+
+
+#Shared by every caller of the process, survives warm Lambda invocations
+CREDENTIALS = CredentialCache()
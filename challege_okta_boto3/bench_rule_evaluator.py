@@ -0,0 +1,98 @@
+'''
+----------------------------------------------------------------------------------
+Benchmark of the rule evaluator against the old rule by rule loops
+(check_portrange / check_singleport) on synthetic ingress rules.
+Usage: python bench_rule_evaluator.py --rules 100000
+----------------------------------------------------------------------------------
+'''
+
+import argparse
+import random
+import time
+
+import rule_evaluator
+
+blacklist_ports = [443, 53, 21, 20, 4333, 3306, 137, 138, 5432, 3389, 25, 1433, 1434, 23, 5500, 5900, 135, 22]
+
+
+#Old implementation, kept here only for the comparison
+def check_portrange(inbound_rule, blacklist_ports):
+    hit = None
+    fromport = inbound_rule.get("fromPort")
+    toport = inbound_rule.get("toPort")
+    if fromport:
+        for port in blacklist_ports:
+            if fromport < port < toport:
+                hit = port
+    return hit
+
+def check_singleport(inbound_rule, blacklist_ports):
+    hit = None
+    for port in blacklist_ports:
+        if inbound_rule["fromPort"] == inbound_rule["toPort"] == port:
+            hit = inbound_rule["fromPort"]
+    return hit
+
+def legacy_evaluate(ip_permissions, blacklist_ports):
+    black_rules = []
+    for inbound_rule in ip_permissions:
+        for cidr in inbound_rule["ipv4Ranges"]:
+            if cidr["cidrIp"] == "0.0.0.0/0" and inbound_rule["ipProtocol"] == "tcp":
+                if check_portrange(inbound_rule, blacklist_ports):
+                    black_rules.append(inbound_rule)
+                if check_singleport(inbound_rule, blacklist_ports):
+                    black_rules.append(inbound_rule)
+            if cidr["cidrIp"] == "0.0.0.0/0" and inbound_rule["ipProtocol"] == "-1":
+                black_rules.append(inbound_rule)
+    return black_rules
+
+
+def synthetic_rules(count, seed=42):
+    rng = random.Random(seed)
+    rules = []
+    for _ in range(count):
+        from_port = rng.randint(1, 65535)
+        to_port = from_port if rng.random() < 0.5 else min(65535, from_port + rng.randint(0, 2000))
+        rules.append({
+            "ipProtocol": rng.choice(["tcp", "tcp", "tcp", "udp", "-1"]),
+            "fromPort": from_port,
+            "toPort": to_port,
+            "ipv4Ranges": [{"cidrIp": rng.choice(["0.0.0.0/0", "10.0.0.0/8"])}],
+        })
+    return rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rule evaluator benchmark')
+    parser.add_argument("--rules", type=int, default=100000, help="Number of synthetic rules")
+    parser.add_argument("--below", type=int, default=0, help="Blacklist every port below this number instead of the default list")
+    args = parser.parse_args()
+
+    ports = list(range(args.below)) if args.below else blacklist_ports
+    rules = synthetic_rules(args.rules)
+    blacklist = rule_evaluator.PortBlacklist(ports)
+
+    start = time.perf_counter()
+    legacy = legacy_evaluate(rules, ports)
+    legacy_time = time.perf_counter() - start
+
+    #end to end, including the flattening of the permission dicts
+    start = time.perf_counter()
+    flagged = rule_evaluator.uncompliant_permissions(rules, blacklist)
+    new_time = time.perf_counter() - start
+
+    #evaluation only, on rules already flattened to (fromPort, toPort, cidr, protocol) tuples
+    tuples = list(rule_evaluator.flatten_permissions(rules))
+    start = time.perf_counter()
+    hits = rule_evaluator.evaluate(tuples, blacklist)
+    batch_time = time.perf_counter() - start
+
+    backend = "numpy" if rule_evaluator.np is not None else "bisect"
+    print(f"rules:       {args.rules} ({len(blacklist.ports)} blacklisted ports, {backend} backend)")
+    print(f"legacy:      {legacy_time:.3f}s  {len({id(rule) for rule in legacy})} flagged")
+    print(f"end to end:  {new_time:.3f}s  {len(flagged)} flagged (range ends included)  {legacy_time / new_time:.1f}x")
+    print(f"batch only:  {batch_time:.3f}s  {sum(hit is not None for hit in hits)} flagged  {legacy_time / batch_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@ import boto3
 import argparse
 from botocore.config import Config
 
+import rule_evaluator
+
 #Initialize argparser
 parser = argparse.ArgumentParser(description='EC2 compliance check')
 parser.add_argument("--regions", type=str, help="AWS region, e.g. --regions='us-east-1,us-east-2'")
@@ -25,16 +27,10 @@ for region in regions:
 
     sgs = list(ec2.security_groups.all())
 
-    for sg in sgs:
-        for rule in sg.ip_permissions:
-            # Check if list of IpRanges is not empty, source ip meets conditions
-            if len(rule.get('IpRanges')) > 0 and rule.get('IpRanges')[0]['CidrIp'] == '0.0.0.0/0':
-                if not rule.get('FromPort'):
-                    uncompliant_ec2_list.append(sg)
-              
-
-                if rule.get('FromPort') and rule.get('FromPort') < rule.get('FromPort') != 80 and rule.get('FromPort') != 443:
-                    uncompliant_ec2_list.append(sg)
+    # Any open port below 1024 that is not 80 or 443 is uncompliant
+    blacklist = rule_evaluator.PortBlacklist.below(1024, allowed=(80, 443))
+    flagged = rule_evaluator.flag_groups([sg.ip_permissions for sg in sgs], blacklist, protocols=None)
+    uncompliant_ec2_list.extend(sg for sg, flag in zip(sgs, flagged) if flag)
     
     ec2 = boto3.client('ec2', config=config, region_name=region)
                
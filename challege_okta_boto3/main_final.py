@@ -1,59 +1,63 @@
-import boto3
 import argparse
-from botocore.config import Config
+import sys
+import time
+
+import accounts
+import remediation
+import scan_engine
+import sg_cache
 
 #Initialize argparser
 parser = argparse.ArgumentParser(description='EC2 compliance check')
 parser.add_argument("--regions", type=str, help="AWS region, e.g. --regions='us-east-1,us-east-2'")
+parser.add_argument("--accounts", type=str, help="Account ids to scan through AssumeRole, e.g. --accounts='111111111111,222222222222'")
+parser.add_argument("--role-name", type=str, default=accounts.ROLE_NAME, help="Role assumed in every account of --accounts")
+parser.add_argument("--workers", type=int, default=scan_engine.MAX_WORKERS, help="Max number of concurrent scan tasks")
+parser.add_argument("--no-filters", action="store_true", help="Pull the full inventory instead of using server side filters")
+parser.add_argument("--compare-filters", action="store_true", help="Run a filtered and an unfiltered scan, print the differences and exit")
+parser.add_argument("--no-cache", action="store_true", help="Do not use the security group cache")
+parser.add_argument("--cache-path", type=str, default=sg_cache.CACHE_PATH, help="SQLite file of the security group cache")
+parser.add_argument("--cache-ttl", type=int, default=sg_cache.CACHE_TTL, help="Seconds a cached region snapshot is reused without calling EC2")
+parser.add_argument("--invalidate-cache", action="store_true", help="Drop the cached snapshots of the scanned regions before scanning")
 args = parser.parse_args()
-regions = [args.regions]
-
-#AWS configuration for retry
-config = Config(
-    retries = dict(
-        max_attempts = 10
-    )
-)
-
-
-#appends uncompliant security groups to list
-uncompliant_security_groups = []
+regions = scan_engine.parse_regions(args.regions)
+account_ids = accounts.parse_accounts(args.accounts) if args.accounts else None
 
-for region in regions:
-    ec2 = boto3.resource('ec2', config=config, region_name=region)
+cache = None
+if not args.no_cache and not args.compare_filters:
+    cache = sg_cache.SecurityGroupCache(args.cache_path, args.cache_ttl)
+    if args.invalidate_cache:
+        #entries are keyed by account id, resolve the one of the default credentials
+        for account in (account_ids or [scan_engine.get_account_id(regions[0])]):
+            for region in regions:
+                cache.invalidate(account=account, region=region)
 
-    sgs = list(ec2.security_groups.all())
+if args.compare_filters:
+    filtered_results = scan_engine.scan_regions(regions, max_workers=args.workers, filtered=True, account_ids=account_ids,
+                                                role_name=args.role_name)
+    unfiltered_results = scan_engine.scan_regions(regions, max_workers=args.workers, filtered=False, account_ids=account_ids,
+                                                  role_name=args.role_name)
+    sys.exit(0 if scan_engine.compare_results(filtered_results, unfiltered_results) else 1)
 
-    for sg in sgs:
-        for rule in sg.ip_permissions:
-            # Check if list of IpRanges is not empty, source ip meets conditions
-            if len(rule.get('IpRanges')) > 0 and rule.get('IpRanges')[0]['CidrIp'] == '0.0.0.0/0':
-                if not rule.get('FromPort'):
-                    uncompliant_security_groups.append(sg)
-              
+#scans every region concurrently, wall-clock is the slowest region instead of the sum
+start = time.perf_counter()
+results = scan_engine.scan_regions(regions, max_workers=args.workers, filtered=not args.no_filters, cache=cache, account_ids=account_ids,
+                                   role_name=args.role_name)
+scan_engine.print_timings(results, time.perf_counter() - start)
 
-                if rule.get('FromPort') and rule.get('FromPort') < rule.get('FromPort') != 80 and rule.get('FromPort') != 443:
-                    uncompliant_security_groups.append(sg)
-
-           
-#compares security groups assigned to instances to the ones in the uncompliant list
+#merges results and stops uncompliant instances per account and region
 uncompliant_ec2_list = []
 
-
-for region in regions:
-    uncompliant_region= [] 
-    ec2 = boto3.client('ec2', config=config, region_name=region)
-
-    response = ec2.describe_instances()
-    for reservation in response["Reservations"]:
-        for instance in reservation["Instances"]:
-            if instance["SecurityGroups"] not in uncompliant_security_groups:  
-                uncompliant_ec2 = {'Instance_ID': instance["InstanceId"], 'Private_IP': instance["PrivateIpAddress"]}
-                uncompliant_region.append(uncompliant_ec2)
-    uncompliant_instance_ids = [instance["Instance_ID"] for instance in uncompliant_region]
-    uncompliant_ec2_list.extend(uncompliant_region)
+for result in results:
+    region = result['region']
+    if result['error']:
+        continue
+    uncompliant_instance_ids = [instance["Instance_ID"] for instance in result['uncompliant_ec2']]
+    uncompliant_ec2_list.extend(result['uncompliant_ec2'])
     if uncompliant_instance_ids:
-        response = ec2.stop_instances(InstanceIds=uncompliant_instance_ids,)
+        ec2 = scan_engine.get_client('ec2', region, result['account'], args.role_name)
+        report = remediation.stop_instances(ec2, uncompliant_instance_ids)
+        remediation.print_report(report, scan_engine.result_label(result))
         print(f"estas se apagaron: {uncompliant_instance_ids}")
     else:
         print("no se apagaron de " + region)
@@ -14,6 +14,8 @@ import boto3
 import argparse
 from botocore.config import Config
 
+import rule_evaluator
+
 # Lists for testing
 regions = ["eu-west-1"]
 
@@ -37,17 +39,13 @@ uncompliant_security_groups = []
 for region in regions:
     ec2 = boto3.resource('ec2', config=config, region_name=region)
 
-    sgs = list(ec2.security_groups.all())
-
-    for sg in sgs:
-        for rule in sg.ip_permissions:
-            # Check if list of IpRanges is not empty, source ip meets conditions
-            if len(rule.get('IpRanges')) > 0 and rule.get('IpRanges')[0]['CidrIp'] == '0.0.0.0/0':
-                if not rule.get('FromPort'):
-                    uncompliant_security_groups.append(sg)
+    # Only groups with a 0.0.0.0/0 rule are requested
+    sgs = list(ec2.security_groups.filter(Filters=[{'Name': 'ip-permission.cidr', 'Values': ['0.0.0.0/0']}]))
 
-                if rule.get('FromPort') and rule.get('FromPort') < 1024 and rule.get('FromPort') != 80 and rule.get('FromPort') != 443 and rule.get('FromPort') != 22:
-                    uncompliant_security_groups.append(sg)
+    # Any open port below 1024 that is not 80, 443 or 22 is uncompliant
+    blacklist = rule_evaluator.PortBlacklist.below(1024, allowed=(80, 443, 22))
+    flagged = rule_evaluator.flag_groups([sg.ip_permissions for sg in sgs], blacklist, protocols=None)
+    uncompliant_security_groups.extend(sg for sg, flag in zip(sgs, flagged) if flag)
 
 #compares security groups assigned to instances to the ones in the uncompliant list
 uncompliant_ec2_list = []
@@ -55,7 +53,7 @@ uncompliant_ec2_list = []
 for region in regions:
     ec2 = boto3.client('ec2', config=config, region_name=region)
 
-    response = ec2.describe_instances()
+    response = ec2.describe_instances(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
     for reservation in response["Reservations"]:
         for instance in reservation["Instances"]:
             if instance["SecurityGroups"] not in uncompliant_security_groups:
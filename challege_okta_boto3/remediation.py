@@ -0,0 +1,125 @@
+'''
+----------------------------------------------------------------------------------
+Shared remediation dispatcher for stop_instances and terminate_instances.
+Instance ids are split in chunks, chunks are sent concurrently under a token
+bucket rate limiter and throttled chunks are retried with jittered backoff.
+Used by main_final.py (compliance check), stop.py (tag based stop) and
+shutdown.py (RunInstances tag enforcer).
+----------------------------------------------------------------------------------
+'''
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore
+
+#Instance ids sent per call, keeps every request well below the size limits
+MAX_BATCH_SIZE = 1000
+MAX_WORKERS = 4
+#Requests per second allowed by the token bucket, and the burst size
+RATE = 5
+BURST = 5
+MAX_RETRIES = 5
+BASE_DELAY = 0.5
+MAX_DELAY = 20
+
+THROTTLING_ERRORS = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'TooManyRequestsException')
+
+
+class TokenBucket:
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def chunks(items, size=MAX_BATCH_SIZE):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def is_throttling_error(e):
+    return isinstance(e, botocore.exceptions.ClientError) and e.response['Error']['Code'] in THROTTLING_ERRORS
+
+
+def backoff_delay(attempt):
+    # Full jitter: random delay between 0 and the exponential cap
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def _dispatch_chunk(call, response_key, chunk, bucket, max_retries):
+    result = {'instance_ids': chunk, 'done': 0, 'attempts': 0, 'latency': 0.0, 'error': None}
+    start = time.perf_counter()
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        result['attempts'] += 1
+        try:
+            response = call(InstanceIds=chunk)
+            result['done'] = len(response.get(response_key, chunk))
+            break
+        except Exception as e:
+            if not is_throttling_error(e) or attempt == max_retries:
+                result['error'] = e
+                break
+            time.sleep(backoff_delay(attempt))
+    result['latency'] = time.perf_counter() - start
+    return result
+
+
+def dispatch(call, response_key, action, instance_ids, batch_size=MAX_BATCH_SIZE, max_workers=MAX_WORKERS,
+             rate=RATE, burst=BURST, max_retries=MAX_RETRIES):
+    """Calls an InstanceIds based ec2 operation over chunks of instance_ids and returns a report.
+
+    call is the bound client method (e.g. client.stop_instances) and response_key the
+    list of the response that holds the affected instances. The report has the keys
+    action, done (total instances affected), failed (instance ids whose chunk failed)
+    and chunks (one dict per chunk with instance_ids, done, attempts, latency and error).
+    """
+    bucket = TokenBucket(rate, burst)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_dispatch_chunk, call, response_key, chunk, bucket, max_retries)
+                   for chunk in chunks(instance_ids, batch_size)]
+        results = [future.result() for future in futures]
+
+    return {
+        'action': action,
+        'done': sum(result['done'] for result in results),
+        'failed': [instance_id for result in results if result['error'] for instance_id in result['instance_ids']],
+        'chunks': results,
+    }
+
+
+def stop_instances(client, instance_ids, **kwargs):
+    """Stops instance_ids with one ec2 client, see dispatch for the options and the report."""
+    return dispatch(client.stop_instances, 'StoppingInstances', 'stopped', instance_ids, **kwargs)
+
+
+def terminate_instances(client, instance_ids, **kwargs):
+    """Terminates instance_ids with one ec2 client, see dispatch for the options and the report."""
+    return dispatch(client.terminate_instances, 'TerminatingInstances', 'terminated', instance_ids, **kwargs)
+
+
+def print_report(report, region=None):
+    prefix = f"{region}: " if region else ""
+    for i, result in enumerate(report['chunks']):
+        status = f"error: {result['error']}" if result['error'] else f"{result['done']} {report['action']}"
+        print(f"{prefix}chunk {i} {len(result['instance_ids'])} ids, {result['attempts']} attempts, {result['latency']:.2f}s, {status}")
+    print(f"{prefix}{report['done']} instances {report['action']}, {len(report['failed'])} failed")
@@ -0,0 +1,219 @@
+'''
+----------------------------------------------------------------------------------
+Rule evaluator for security group ingress permissions.
+The blacklisted ports are compiled once into a sorted array. Ip permissions are
+filtered and looked up in a single pass, with one binary search per permission
+whatever the number of open ranges it has. Batches of already flattened
+(fromPort, toPort, cidr, protocol) tuples are tested at once by evaluate()
+(vectorized with numpy when it is installed).
+Every IpRanges entry of a permission is checked, not only the first one.
+Protocol numbers (6, 17, 1, 58) are understood as their names.
+ICMP permissions are skipped, their ports are an ICMP type and code.
+Understands both the EC2 API shape (IpRanges/CidrIp/FromPort) and the AWS Config
+shape (ipv4Ranges/cidrIp/fromPort) of ip permissions.
+----------------------------------------------------------------------------------
+'''
+
+import hashlib
+import json
+from bisect import bisect_left
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MIN_PORT = 0
+MAX_PORT = 65535
+OPEN_CIDRS = ('0.0.0.0/0',)
+#Protocols checked by default, -1 means all protocols (and all ports)
+PROTOCOLS = ('tcp', '-1')
+#IpProtocol may be a name or a protocol number, numbers are compared by name
+PROTOCOL_NAMES = {'6': 'tcp', '17': 'udp', '1': 'icmp', '58': 'icmpv6'}
+#Never checked against the blacklist
+ICMP_PROTOCOLS = ('icmp', 'icmpv6')
+#Bumped whenever a change of the evaluation logic may change a verdict, invalidates cached verdicts
+EVALUATOR_VERSION = 3
+
+
+class PortBlacklist:
+
+    def __init__(self, ports):
+        self.ports = sorted({int(port) for port in ports})
+        self.array = np.array(self.ports, dtype=np.int64) if np is not None else None
+
+    @classmethod
+    def from_string(cls, ports):
+        """Builds the blacklist from a comma separated string, e.g. "22, 3389"."""
+        return cls(port.strip() for port in ports.split(",") if port.strip())
+
+    @classmethod
+    def below(cls, limit, allowed=()):
+        """Blacklists every port below limit except the allowed ones."""
+        return cls(port for port in range(limit) if port not in allowed)
+
+    def hits(self, from_ports, to_ports):
+        """Returns, for every [from, to] range, the lowest blacklisted port inside it or None."""
+        if not self.ports:
+            return [None] * len(from_ports)
+        if self.array is not None:
+            from_ports = np.asarray(from_ports, dtype=np.int64)
+            to_ports = np.asarray(to_ports, dtype=np.int64)
+            index = np.searchsorted(self.array, from_ports, side='left')
+            candidates = self.array[np.minimum(index, len(self.array) - 1)]
+            found = (index < len(self.array)) & (candidates <= to_ports)
+            return [int(port) if hit else None for port, hit in zip(candidates, found)]
+
+        result = []
+        for from_port, to_port in zip(from_ports, to_ports):
+            index = bisect_left(self.ports, from_port)
+            if index < len(self.ports) and self.ports[index] <= to_port:
+                result.append(self.ports[index])
+            else:
+                result.append(None)
+        return result
+
+
+def protocol_name(protocol):
+    """Returns the name of an IpProtocol value, e.g. "6" -> "tcp"."""
+    protocol = str(protocol).lower()
+    return PROTOCOL_NAMES.get(protocol, protocol)
+
+
+def _normalize(permission):
+    # Returns (fromPort, toPort, protocol name, ip ranges, cidr key) of a permission of
+    # either shape, or None for ICMP
+    if 'IpRanges' in permission:
+        protocol = permission.get('IpProtocol', '-1')
+        from_port = permission.get('FromPort')
+        to_port = permission.get('ToPort', from_port)
+        ip_ranges, cidr_key = permission['IpRanges'], 'CidrIp'
+    else:
+        protocol = permission.get('ipProtocol', '-1')
+        from_port = permission.get('fromPort')
+        to_port = permission.get('toPort', from_port)
+        ip_ranges, cidr_key = permission.get('ipv4Ranges', []), 'cidrIp'
+    protocol = PROTOCOL_NAMES.get(protocol, protocol)
+    if protocol in ICMP_PROTOCOLS:
+        return None
+    if protocol == '-1' or from_port is None or from_port < 0:
+        from_port, to_port = MIN_PORT, MAX_PORT
+    elif to_port is None or to_port < 0:
+        to_port = MAX_PORT
+    return from_port, to_port, protocol, ip_ranges, cidr_key
+
+
+def _candidates(ip_permissions, protocols, open_cidrs):
+    # Yields (index, fromPort, toPort) once per permission with a checked protocol and
+    # at least one open cidr, the port range is shared by all the ranges of a permission.
+    # Same rules as _normalize, inlined and with the cheapest filters first since
+    # this is the hot loop of every evaluation.
+    for index, permission in enumerate(ip_permissions):
+        if 'IpRanges' in permission:
+            ip_ranges, cidr_key = permission['IpRanges'], 'CidrIp'
+            protocol_key, from_key, to_key = 'IpProtocol', 'FromPort', 'ToPort'
+        else:
+            ip_ranges, cidr_key = permission.get('ipv4Ranges', ()), 'cidrIp'
+            protocol_key, from_key, to_key = 'ipProtocol', 'fromPort', 'toPort'
+        for ip_range in ip_ranges:
+            if ip_range.get(cidr_key) in open_cidrs:
+                break
+        else:
+            continue
+        protocol = permission.get(protocol_key, '-1')
+        protocol = PROTOCOL_NAMES.get(protocol, protocol)
+        if protocol in ICMP_PROTOCOLS or (protocols is not None and protocol not in protocols):
+            continue
+        from_port = permission.get(from_key)
+        to_port = permission.get(to_key, from_port)
+        if protocol == '-1' or from_port is None or from_port < 0:
+            from_port, to_port = MIN_PORT, MAX_PORT
+        elif to_port is None or to_port < 0:
+            to_port = MAX_PORT
+        yield index, from_port, to_port
+
+
+def flatten_permissions(ip_permissions):
+    """Yields one (fromPort, toPort, cidr, protocol) tuple per IpRanges entry.
+
+    A missing port, a negative port or protocol -1 is expanded to the full port range.
+    Protocol numbers are returned as their names.
+    ICMP permissions are skipped, their FromPort/ToPort are an ICMP type and code.
+    """
+    for permission in ip_permissions:
+        normalized = _normalize(permission)
+        if normalized is None:
+            continue
+        from_port, to_port, protocol, ip_ranges, cidr_key = normalized
+        for ip_range in ip_ranges:
+            yield from_port, to_port, ip_range.get(cidr_key), protocol
+
+
+def fingerprint(blacklist, protocols=PROTOCOLS, open_cidrs=OPEN_CIDRS):
+    """Hash of everything a verdict depends on besides the permissions: evaluator version,
+    blacklisted ports, checked protocols and open cidrs."""
+    content = [EVALUATOR_VERSION, blacklist.ports,
+               sorted(_protocol_names(protocols)) if protocols is not None else None,
+               sorted(open_cidrs)]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+
+def evaluate(rules, blacklist, protocols=PROTOCOLS, open_cidrs=OPEN_CIDRS):
+    """Tests a batch of (fromPort, toPort, cidr, protocol) tuples at once.
+
+    Returns one entry per rule: the blacklisted port it exposes, or None.
+    protocols=None checks every protocol.
+    """
+    rules = list(rules)
+    protocols = _protocol_names(protocols)
+    result = [None] * len(rules)
+    candidates = []
+    for i, (_, _, cidr, protocol) in enumerate(rules):
+        if cidr in open_cidrs:
+            protocol = PROTOCOL_NAMES.get(protocol, protocol)
+            if protocol not in ICMP_PROTOCOLS and (protocols is None or protocol in protocols):
+                candidates.append(i)
+    if not candidates:
+        return result
+    hits = blacklist.hits([rules[i][0] for i in candidates], [rules[i][1] for i in candidates])
+    for i, hit in zip(candidates, hits):
+        result[i] = hit
+    return result
+
+
+def _protocol_names(protocols):
+    return None if protocols is None else frozenset(protocol_name(protocol) for protocol in protocols)
+
+
+def _flag(count, candidates, blacklist):
+    # candidates yields the (owner, fromPort, toPort) to test, returns one bool per owner.
+    # The candidates come out of a Python loop over the permissions anyway, so they are
+    # looked up in the same pass: handing them to numpy would cost more in list and
+    # array building than the vectorized search saves (see bench_rule_evaluator.py).
+    flagged = [False] * count
+    ports = blacklist.ports
+    for owner, from_port, to_port in candidates:
+        index = bisect_left(ports, from_port)
+        if index < len(ports) and ports[index] <= to_port:
+            flagged[owner] = True
+    return flagged
+
+
+def flag_groups(permission_lists, blacklist, protocols=PROTOCOLS, open_cidrs=OPEN_CIDRS):
+    """Evaluates the ip permissions of many security groups in one batch.
+
+    permission_lists holds one list of ip permissions per group, returns one bool per group.
+    Only the permissions with an open cidr and a checked protocol reach the port lookup.
+    """
+    protocols = _protocol_names(protocols)
+    candidates = ((index, from_port, to_port)
+                  for index, ip_permissions in enumerate(permission_lists)
+                  for _, from_port, to_port in _candidates(ip_permissions, protocols, open_cidrs))
+    return _flag(len(permission_lists), candidates, blacklist)
+
+
+def uncompliant_permissions(ip_permissions, blacklist, protocols=PROTOCOLS, open_cidrs=OPEN_CIDRS):
+    """Returns the ip permissions that expose at least one blacklisted port."""
+    flagged = _flag(len(ip_permissions), _candidates(ip_permissions, _protocol_names(protocols), open_cidrs),
+                    blacklist)
+    return [permission for permission, flag in zip(ip_permissions, flagged) if flag]
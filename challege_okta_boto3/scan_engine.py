@@ -0,0 +1,275 @@
+'''
+----------------------------------------------------------------------------------
+Concurrent multi-region scan engine for the EC2 compliance check.
+Every region is split in two phases (security groups and instances) and each
+phase runs as its own task in one bounded thread pool, so a full scan takes
+about as long as the slowest region instead of the sum of all of them.
+Instances are streamed page by page and matched against a set of GroupIds.
+Predicates are pushed down to EC2 with Filters unless filtered=False.
+Security group verdicts can be cached on disk between runs (see sg_cache.py).
+Several accounts can be scanned at once through STS AssumeRole (see accounts.py).
+----------------------------------------------------------------------------------
+'''
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
+
+import accounts
+import rule_evaluator
+import sg_cache
+
+#AWS configuration for retry
+config = Config(
+    retries = dict(
+        max_attempts = 10
+    )
+)
+
+MAX_WORKERS = 16
+
+#Server side filters, only candidate resources cross the wire
+SG_FILTERS = [{'Name': 'ip-permission.cidr', 'Values': ['0.0.0.0/0']}]
+#Only running instances can be stopped, StopInstances rejects pending ones with IncorrectInstanceState
+INSTANCE_STATES = ['running']
+#describe_instances accepts at most 200 values per filter
+GROUP_ID_BATCH_SIZE = 200
+
+#Any open port below 1024 that is not 80 or 443 is uncompliant, on any protocol
+BLACKLIST = rule_evaluator.PortBlacklist.below(1024, allowed=(80, 443))
+
+#Role assumed in every account of a multi-account scan, unless scan_regions is given another one
+ROLE_NAME = accounts.ROLE_NAME
+
+#Clients and resources of every (account, region, service), shared by the scan workers
+CLIENT_POOL = accounts.ClientPool(accounts.CREDENTIALS, config=config)
+
+#the account id of the default credentials, cached per worker
+_local = threading.local()
+
+
+def _role_arn(account, role_name):
+    return accounts.role_arn(account, role_name) if account else None
+
+
+def get_client(service, region, account=None, role_name=ROLE_NAME):
+    """Returns the client of an account (role_name assumed in it), or of the default credentials."""
+    return CLIENT_POOL.get_client(service, _role_arn(account, role_name), region)
+
+
+def get_resource(service, region, account=None, role_name=ROLE_NAME):
+    """Returns the resource of an account for the current worker, see get_client."""
+    return CLIENT_POOL.get_resource(service, _role_arn(account, role_name), region)
+
+
+def parse_regions(regions):
+    """Splits a comma separated --regions value into a list of region names."""
+    return [region.strip() for region in regions.split(',') if region.strip()]
+
+
+def get_account_id(region, account=None):
+    """Returns the account id of the scanned account, for the default credentials it is cached per worker."""
+    if account:
+        return account
+    if not hasattr(_local, 'account_id'):
+        _local.account_id = get_client('sts', region).get_caller_identity()['Account']
+    return _local.account_id
+
+
+def scan_security_groups(region, filtered=True, cache=None, account=None, role_name=ROLE_NAME):
+    """Phase 1: returns (uncompliant GroupIds, cache status) for a region.
+
+    With filtered=True only groups with a 0.0.0.0/0 rule are requested from EC2,
+    the rules are still evaluated locally.
+    With a cache, a fresh region snapshot is returned without calling EC2 and
+    otherwise only the groups whose ip_permissions hash changed are evaluated.
+    """
+    account_id = None
+    cached = {}
+    if cache:
+        account_id = get_account_id(region, account)
+        rules_hash = rule_evaluator.fingerprint(BLACKLIST, protocols=None)
+        group_ids = cache.fresh_snapshot(account_id, region, rules_hash)
+        if group_ids is not None:
+            return group_ids, 'snapshot'
+        cached = cache.verdicts(account_id, region, rules_hash)
+
+    ec2 = get_resource('ec2', region, account, role_name)
+    sgs = ec2.security_groups.filter(Filters=SG_FILTERS) if filtered else ec2.security_groups.all()
+
+    verdicts = {}
+    changed = []
+    for sg in sgs:
+        digest = sg_cache.permissions_hash(sg.ip_permissions)
+        if sg.group_id in cached and cached[sg.group_id][0] == digest:
+            verdicts[sg.group_id] = cached[sg.group_id]
+        else:
+            changed.append((sg, digest))
+
+    flagged = rule_evaluator.flag_groups([sg.ip_permissions for sg, _ in changed], BLACKLIST, protocols=None)
+    for (sg, digest), flag in zip(changed, flagged):
+        verdicts[sg.group_id] = (digest, flag)
+
+    if cache:
+        cache.store(account_id, region, verdicts, rules_hash)
+    group_ids = [group_id for group_id, (_, uncompliant) in verdicts.items() if uncompliant]
+    return group_ids, (f'{len(changed)} of {len(verdicts)} groups evaluated' if cache else None)
+
+
+def _batches(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def iter_instances(region, group_ids=None, account=None, role_name=ROLE_NAME):
+    """Yields the instances of a region page by page, following NextToken.
+
+    When group_ids is given only running instances attached to one of those groups
+    are requested, in batches of GROUP_ID_BATCH_SIZE group ids. An instance in
+    several batches is yielded once.
+    """
+    ec2 = get_client('ec2', region, account, role_name)
+    paginator = ec2.get_paginator('describe_instances')
+
+    if group_ids is None:
+        for page in paginator.paginate():
+            for reservation in page["Reservations"]:
+                yield from reservation["Instances"]
+        return
+
+    seen = set()
+    for batch in _batches(sorted(group_ids), GROUP_ID_BATCH_SIZE):
+        filters = [{'Name': 'instance-state-name', 'Values': INSTANCE_STATES},
+                   {'Name': 'instance.group-id', 'Values': batch}]
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    if instance["InstanceId"] not in seen:
+                        seen.add(instance["InstanceId"])
+                        yield instance
+
+
+def match_instances(instances, uncompliant_group_ids):
+    """Returns the running instances that have at least one security group in the uncompliant set.
+
+    instances can be any iterable (e.g. iter_instances), only the matches are kept
+    in memory and every instance costs one set lookup per attached group.
+    """
+    uncompliant_ec2 = []
+    for instance in instances:
+        if instance.get("State", {}).get("Name", "running") not in INSTANCE_STATES:
+            continue
+        if any(sg["GroupId"] in uncompliant_group_ids for sg in instance.get("SecurityGroups", [])):
+            uncompliant_ec2.append({'Instance_ID': instance["InstanceId"], 'Private_IP': instance.get("PrivateIpAddress")})
+    return uncompliant_ec2
+
+
+def scan_instances(region, sg_future, filtered=True, account=None, role_name=ROLE_NAME):
+    """Phase 2: streams the instances of a region against the result of phase 1."""
+    (group_ids, _), _, _ = sg_future.result()
+    uncompliant_group_ids = set(group_ids)
+    if not uncompliant_group_ids:
+        return []
+    instances = iter_instances(region, uncompliant_group_ids if filtered else None, account, role_name)
+    return match_instances(instances, uncompliant_group_ids)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, start, time.perf_counter()
+
+
+def result_label(result):
+    return f"{result['account']}/{result['region']}" if result['account'] else result['region']
+
+
+def scan_regions(regions, max_workers=MAX_WORKERS, filtered=True, cache=None, account_ids=None, role_name=ROLE_NAME):
+    """Scans every region (of every account) concurrently and returns one result dict per target.
+
+    Each result has the keys account, region, uncompliant_security_groups (GroupIds),
+    uncompliant_ec2, elapsed (seconds from the first phase start to the last
+    phase end), cache (how the security groups were served) and error.
+    A failing target does not stop the others, its error is kept in the result.
+    filtered=False disables the server side filters and pulls the full inventory.
+    cache is an optional sg_cache.SecurityGroupCache.
+    account_ids switches to a multi-account scan, role_name is assumed in every
+    account (concurrently, before the scan starts) with the default credentials
+    used as source. The targets of an account whose role could not be assumed are
+    not scanned, their results carry the AssumeRole error. Without account_ids the
+    default credentials are scanned.
+    """
+    assume_errors = {}
+    if account_ids:
+        role_errors = accounts.CREDENTIALS.prefetch([accounts.role_arn(account, role_name) for account in account_ids],
+                                                    max_workers=max_workers)
+        assume_errors = {account: role_errors[accounts.role_arn(account, role_name)] for account in account_ids
+                         if accounts.role_arn(account, role_name) in role_errors}
+        for account, error in assume_errors.items():
+            print(f"{account}: cannot assume {role_name}, skipping its regions: {error}")
+    all_targets = [(account, region) for account in (account_ids or [None]) for region in regions]
+    targets = [(account, region) for account, region in all_targets if account not in assume_errors]
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        #all phase 1 tasks are queued before any phase 2 task, so a phase 2 task
+        #waiting on its phase 1 future never blocks the pool
+        sg_futures = [pool.submit(_timed, scan_security_groups, region, filtered, cache, account, role_name)
+                      for account, region in targets]
+        instance_futures = [pool.submit(_timed, scan_instances, region, sg_future, filtered, account, role_name)
+                            for (account, region), sg_future in zip(targets, sg_futures)]
+
+        for (account, region), sg_future, instance_future in zip(targets, sg_futures, instance_futures):
+            result = {'account': account, 'region': region, 'uncompliant_security_groups': [], 'uncompliant_ec2': [],
+                      'elapsed': 0.0, 'cache': None, 'error': None}
+            try:
+                (group_ids, cache_status), sg_start, sg_end = sg_future.result()
+                uncompliant_ec2, _, instance_end = instance_future.result()
+                result['uncompliant_security_groups'] = group_ids
+                result['cache'] = cache_status
+                result['uncompliant_ec2'] = uncompliant_ec2
+                result['elapsed'] = max(sg_end, instance_end) - sg_start
+            except Exception as e:
+                result['error'] = e
+            results[(account, region)] = result
+    for account, region in all_targets:
+        if account in assume_errors:
+            results[(account, region)] = {'account': account, 'region': region, 'uncompliant_security_groups': [],
+                                          'uncompliant_ec2': [], 'elapsed': 0.0, 'cache': None,
+                                          'error': assume_errors[account]}
+    return [results[target] for target in all_targets]
+
+
+def print_timings(results, total):
+    width = max([16] + [len(result_label(result)) + 1 for result in results])
+    for result in results:
+        status = f"error: {result['error']}" if result['error'] else f"{len(result['uncompliant_ec2'])} uncompliant ec2s"
+        if result['cache']:
+            status += f" (cache: {result['cache']})"
+        print(f"{result_label(result):<{width}} {result['elapsed']:7.2f}s  {status}")
+    print(f"{'total':<{width}} {total:7.2f}s  {len(results)} regions")
+
+
+def _result_ids(result):
+    return (set(result['uncompliant_security_groups']),
+            {instance['Instance_ID'] for instance in result['uncompliant_ec2']})
+
+
+def compare_results(filtered_results, unfiltered_results):
+    """Prints the differences between a filtered and an unfiltered scan, returns True if they match."""
+    match = True
+    for filtered, unfiltered in zip(filtered_results, unfiltered_results):
+        region = result_label(filtered)
+        if filtered['error'] or unfiltered['error']:
+            print(f"{region}: cannot compare, filtered error: {filtered['error']}, unfiltered error: {unfiltered['error']}")
+            match = False
+            continue
+        for name, filtered_ids, unfiltered_ids in zip(('security groups', 'ec2s'), _result_ids(filtered), _result_ids(unfiltered)):
+            if filtered_ids != unfiltered_ids:
+                match = False
+                print(f"{region} {name}: only unfiltered {sorted(unfiltered_ids - filtered_ids)}, only filtered {sorted(filtered_ids - unfiltered_ids)}")
+    print("filtered and unfiltered scans match" if match else "filtered and unfiltered scans differ")
+    return match
@@ -0,0 +1,102 @@
+'''
+----------------------------------------------------------------------------------
+Persistent SQLite cache of security group snapshots for the compliance check.
+Every group is stored per (account, region, GroupId) with a hash of its
+ip_permissions and the last verdict, so only groups whose rules changed are
+evaluated again. A region scanned less than ttl seconds ago is served from the
+cache without calling EC2 at all. The verdicts of a region are only reused under
+the rules fingerprint (blacklist, evaluator version...) they were computed with.
+----------------------------------------------------------------------------------
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ec2_compliance', 'sg_cache.sqlite')
+#Seconds a region snapshot is reused without listing the security groups again
+CACHE_TTL = 900
+
+
+def permissions_hash(ip_permissions):
+    """Content hash of a list of ip permissions, independent of key order."""
+    return hashlib.sha256(json.dumps(ip_permissions, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class SecurityGroupCache:
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        #one connection shared by the scan workers, access is serialized by the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS security_groups (
+                account TEXT, region TEXT, group_id TEXT, permissions_hash TEXT, uncompliant INTEGER,
+                PRIMARY KEY (account, region, group_id))''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS snapshots (
+                account TEXT, region TEXT, scanned_at REAL, PRIMARY KEY (account, region))''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS rules (
+                account TEXT, region TEXT, rules_hash TEXT, PRIMARY KEY (account, region))''')
+
+    def _same_rules(self, account, region, rules_hash):
+        row = self.connection.execute('SELECT rules_hash FROM rules WHERE account = ? AND region = ?',
+                                      (account, region)).fetchone()
+        return bool(row) and row[0] == rules_hash
+
+    def fresh_snapshot(self, account, region, rules_hash):
+        """Returns the uncompliant GroupIds of a region if its snapshot is younger than the ttl
+        and was evaluated under rules_hash, else None."""
+        with self.lock:
+            row = self.connection.execute('SELECT scanned_at FROM snapshots WHERE account = ? AND region = ?',
+                                          (account, region)).fetchone()
+            if not row or time.time() - row[0] > self.ttl or not self._same_rules(account, region, rules_hash):
+                return None
+            rows = self.connection.execute('''SELECT group_id FROM security_groups
+                WHERE account = ? AND region = ? AND uncompliant = 1''', (account, region)).fetchall()
+        return [group_id for group_id, in rows]
+
+    def verdicts(self, account, region, rules_hash):
+        """Returns {GroupId: (permissions_hash, uncompliant)} for the cached groups of a region,
+        empty if they were evaluated under other rules than rules_hash."""
+        with self.lock:
+            if not self._same_rules(account, region, rules_hash):
+                return {}
+            rows = self.connection.execute('''SELECT group_id, permissions_hash, uncompliant FROM security_groups
+                WHERE account = ? AND region = ?''', (account, region)).fetchall()
+        return {group_id: (digest, bool(uncompliant)) for group_id, digest, uncompliant in rows}
+
+    def store(self, account, region, verdicts, rules_hash):
+        """Replaces the snapshot of a region with {GroupId: (permissions_hash, uncompliant)} evaluated under rules_hash."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM security_groups WHERE account = ? AND region = ?', (account, region))
+            self.connection.executemany('INSERT INTO security_groups VALUES (?, ?, ?, ?, ?)',
+                                        [(account, region, group_id, digest, int(uncompliant))
+                                         for group_id, (digest, uncompliant) in verdicts.items()])
+            self.connection.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)', (account, region, time.time()))
+            self.connection.execute('INSERT OR REPLACE INTO rules VALUES (?, ?, ?)', (account, region, rules_hash))
+
+    def invalidate(self, account=None, region=None):
+        """Drops the cached snapshots, all of them or only the ones of an account and/or region."""
+        where = []
+        params = []
+        if account:
+            where.append('account = ?')
+            params.append(account)
+        if region:
+            where.append('region = ?')
+            params.append(region)
+        clause = ' WHERE ' + ' AND '.join(where) if where else ''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM security_groups' + clause, params)
+            self.connection.execute('DELETE FROM snapshots' + clause, params)
+            self.connection.execute('DELETE FROM rules' + clause, params)
+
+    def close(self):
+        self.connection.close()
@@ -1,46 +1,159 @@
-from __future__ import print_function
 import json
-import urllib
+import urllib.parse
 import boto3
 import gzip
 import io
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import remediation
 s3 = boto3.client('s3')
 sns = boto3.client('sns')
 SNS_ARN = 'arn:aws:sns:ap-northeast-2:132323974198:ec2taggingmonitor'
 TAGS = ['production', 'development']
+#Characters read from the decompressed trail file at a time
+CHUNK_SIZE = 64 * 1024
+#describe_tags accepts at most 200 values per filter
+TAG_FILTER_BATCH_SIZE = 200
+#Trail files read in parallel
+MAX_WORKERS = 4
+
+def iter_records(stream, chunk_size=CHUNK_SIZE):
+    # Yields the items of the top level "Records" array one at a time,
+    # only one chunk plus the current record are kept in memory
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while True:
+        index = buffer.find('"Records"')
+        bracket = buffer.find('[', index) if index != -1 else -1
+        if bracket != -1:
+            buffer = buffer[bracket + 1:]
+            break
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except ValueError:
+            # incomplete record, read at least as much as is buffered so a big record is not re-parsed chunk by chunk
+            chunk = stream.read(max(chunk_size, len(buffer)))
+            if not chunk:
+                raise
+            buffer += chunk
+            continue
+        yield record
+        buffer = buffer[end:]
 
-def decompress(data):
-    with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
-        return f.read()
+def iter_trail_records(bucket, key):
+    # Streams the gzipped CloudTrail object from S3 without loading it whole
+    s3_object = s3.get_object(Bucket=bucket, Key=key)
+    with gzip.GzipFile(fileobj=s3_object['Body']) as unzipped:
+        yield from iter_records(io.TextIOWrapper(unzipped, encoding='utf-8'))
 
-def report(instance, user, region):
-    report = "User " + user + " created an instance with non-compliant tag in the region " +  region + ". \n"
-    report += "Instance id: " + instance['instanceId'] + "\n"
-    report += "Instance type: " + instance['instanceType'] + "\n"
-    report += "The instance is being destroyed."
+def report(instances, user, region):
+    report = "User " + user + " created " + str(len(instances)) + " instance(s) with non-compliant tag in the region " +  region + ". \n"
+    for instance in instances:
+        report += "Instance id: " + instance['instanceId'] + ", instance type: " + instance['instanceType'] + "\n"
+    report += "The instances are being destroyed."
     return report
 
+def get_tags(ec2, instance_ids):
+    # Returns {instance_id: {key: value}} with one describe_tags call per batch of ids
+    tags = defaultdict(dict)
+    paginator = ec2.get_paginator('describe_tags')
+    for batch in remediation.chunks(instance_ids, TAG_FILTER_BATCH_SIZE):
+        filters = [{'Name': 'resource-type', 'Values': ['instance']}, {'Name': 'resource-id', 'Values': batch}]
+        for page in paginator.paginate(Filters=filters):
+            for tag in page['Tags']:
+                tags[tag['ResourceId']][tag['Key']] = tag['Value']
+    return tags
+
+def is_compliant(tags):
+    return 'Purpose' in tags and tags['Purpose'] in TAGS
+
+def enforce(launches):
+    # launches is {(user, region): [instance items of RunInstances]}
+    by_region = defaultdict(list)
+    for (user, region), instances in launches.items():
+        by_region[region].extend(instance['instanceId'] for instance in instances)
+
+    for region, instance_ids in by_region.items():
+        ec2 = boto3.client('ec2', region_name=region)
+        tags = get_tags(ec2, instance_ids)
+        non_compliant = [instance_id for instance_id in instance_ids if not is_compliant(tags.get(instance_id, {}))]
+        if not non_compliant:
+            continue
+        termination = remediation.terminate_instances(ec2, non_compliant)
+        remediation.print_report(termination, region)
+        terminated = set(non_compliant) - set(termination['failed'])
+        # One aggregated notification per user and region
+        for (user, launch_region), instances in launches.items():
+            user_terminated = [instance for instance in instances if launch_region == region and instance['instanceId'] in terminated]
+            if user_terminated:
+                sns.publish(TopicArn=SNS_ARN, Message=report(user_terminated, user, region))
+
+class BatchFailure(Exception):
+    pass
+
+def parse_s3_records(event):
+    # Returns ([(item identifier, bucket, key)], [messageId]) for the trail files of the event,
+    # delivered directly by S3 or through SQS, and the SQS messages whose body could not be
+    # parsed. The identifier is the SQS messageId or bucket/key.
+    records = []
+    malformed = []
+    for record in event['Records']:
+        if record.get('eventSource') == 'aws:sqs':
+            try:
+                s3_records = [(s3_record['s3']['bucket']['name'], s3_record['s3']['object']['key'])
+                              for s3_record in json.loads(record['body']).get('Records', [])]
+            except (KeyError, TypeError, AttributeError, ValueError) as e:
+                print(f"Malformed message {record.get('messageId')}: {type(e).__name__}: {e}")
+                malformed.append(record['messageId'])
+                continue
+            identifier = record['messageId']
+        else:
+            s3_records = [(record['s3']['bucket']['name'], record['s3']['object']['key'])]
+            identifier = None
+        for bucket, key in s3_records:
+            key = urllib.parse.unquote_plus(key, encoding='utf-8')
+            records.append((identifier or f"{bucket}/{key}", bucket, key))
+    return records, malformed
+
+def read_launches(bucket, key):
+    # Returns {(user, region): [instance items]} of the RunInstances events of one trail file
+    launches = defaultdict(list)
+    for record in iter_trail_records(bucket, key):
+        if record.get('eventName') == "RunInstances":
+            user = record['userIdentity']['userName']
+            region = record['awsRegion']
+            launches[(user, region)].extend(record['responseElements']['instancesSet']['items'])
+    return launches
+
 def lambda_handler(event, context):
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.unquote_plus(event['Records'][0]['s3']['object']['key'].encode('utf8'))
-    try:
-        s3_object = s3.get_object(Bucket=bucket, Key=key)
-        s3_object_content = s3_object['Body'].read()
-        s3_object_unzipped_content = decompress(s3_object_content)
-        json_object = json.loads(s3_object_unzipped_content)
-        for record in json_object['Records']:
-            if record['eventName'] == "RunInstances":
-                user = record['userIdentity']['userName']
-                region = record['awsRegion']
-                ec2 = boto3.resource('ec2', region_name=region)
-                for index, instance in enumerate(record['responseElements']['instancesSet']['items']):
-                    instance_object = ec2.Instance(instance['instanceId'])
-                    tags = {}
-                    for tag in instance_object.tags:
-                        tags[tag['Key']] = tag['Value']
-                    if('Purpose' not in tags or tags['Purpose'] not in TAGS):
-                        instance_object.terminate()
-                        sns.publish(TopicArn=SNS_ARN, Message=report(instance, user, region))
-    except Exception as e:
-        print(e)
-        raise e
\ No newline at end of file
+    # Reads every trail file in parallel and enforces the tags once for all of them.
+    # Through SQS the files that could not be read are returned in the partial batch
+    # response format, a direct S3 invocation raises so Lambda retries it.
+    records, malformed = parse_s3_records(event)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [pool.submit(read_launches, bucket, key) for _, bucket, key in records]
+
+    launches = defaultdict(list)
+    failed = list(malformed)
+    for (identifier, bucket, key), future in zip(records, futures):
+        try:
+            for user_region, instances in future.result().items():
+                launches[user_region].extend(instances)
+        except Exception as e:
+            print(f"Failed reading {bucket}/{key}: {e}")
+            if identifier not in failed:
+                failed.append(identifier)
+    enforce(launches)
+    if failed and not any(record.get('eventSource') == 'aws:sqs' for record in event['Records']):
+        #asynchronous S3 invocations ignore batchItemFailures, raising makes Lambda retry the event
+        raise BatchFailure(f"{len(failed)} trail files failed: {', '.join(failed)}")
+    return {'batchItemFailures': [{'itemIdentifier': identifier} for identifier in failed]}
@@ -1,5 +1,6 @@
 import json
 import boto3
+import remediation
 
 ec2 = boto3.client('ec2', region_name='eu-west-1')
 
@@ -7,12 +8,18 @@ def lambda_handler(event, context):
     ec2_instances = ec2.describe_instances()
     ec2_reservations = ec2_instances['Reservations']
 
+    instance_ids = []
     for reservation in ec2_reservations:
         instances = reservation['Instances']
 
         for instance in instances:
             if should_stop_instance(instance):
-                stop_instance(instance)
+                instance_ids.append(instance['InstanceId'])
+
+    if instance_ids:
+        report = remediation.stop_instances(ec2, instance_ids)
+        remediation.print_report(report)
+        print("The instances are stopped:" + ", ".join(instance_ids))
 
 
 def should_stop_instance(instance):
@@ -26,9 +33,3 @@ def should_stop_instance(instance):
 
     return should_stop
 
-
-def stop_instance(instance):
-    instance_id = instance['InstanceId']
-
-    ec2.stop_instances(InstanceIds=[instance_id])
-    print("The instance is stopped:" + instance_id)
\ No newline at end of file
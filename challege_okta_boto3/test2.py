@@ -3,9 +3,17 @@
 import json
 import sys
 import datetime
+import functools
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import botocore
 
+import accounts
+import remediation
+import rule_evaluator
+
 
 ##############
 # Parameters #
@@ -20,6 +28,19 @@ ASSUME_ROLE_MODE = False
 # Other parameters (no change needed)
 CONFIG_ROLE_TIMEOUT_SECONDS = 900
 
+# put_evaluations accepts at most 100 evaluations per call, batches are sent concurrently
+PUT_EVALUATIONS_BATCH_SIZE = 100
+PUT_EVALUATIONS_WORKERS = 8
+# Total number of throttling retries shared by all the batches of one invocation
+PUT_EVALUATIONS_RETRY_BUDGET = 20
+
+# Number of oversized configuration items kept in memory across warm invocations
+CONFIGURATION_CACHE_SIZE = 256
+
+# Credentials are cached per role until shortly before they expire and clients are reused
+# per (role, region, service) across warm invocations.
+CLIENT_POOL = accounts.ClientPool(accounts.CredentialCache(lambda role_arn, region: get_assume_role_credentials(role_arn, region)))
+
 blacklist_ports = [443, 53, 21, 20, 4333, 3306, 137, 138, 5432, 3389, 25, 1433, 1434, 23, 5500, 5900, 135, 22]
 AFFECTED_RULES = []
 
@@ -28,20 +49,8 @@ AFFECTED_RULES = []
 #############
 
 def evaluate_compliance(event, configuration_item, valid_rule_parameters):
-    blacklist_ports = []
-    inbound_rule = []
-    black_rules = []
-    for port_num in valid_rule_parameters["BlacklistedPorts"].split(","):
-        blacklist_ports.append(int(port_num.strip()))
-    for inbound_rule in configuration_item['configuration']['ipPermissions']:
-        for cidr in inbound_rule["ipv4Ranges"]:
-            if cidr["cidrIp"] == "0.0.0.0/0" and inbound_rule["ipProtocol"] == "tcp":
-                if check_portrange(inbound_rule, blacklist_ports):
-                    black_rules.append(inbound_rule)
-                if check_singleport(inbound_rule, blacklist_ports):
-                    black_rules.append(inbound_rule)
-            if cidr["cidrIp"] == "0.0.0.0/0" and inbound_rule["ipProtocol"] == "-1":
-                black_rules.append(inbound_rule)
+    blacklist = rule_evaluator.PortBlacklist.from_string(valid_rule_parameters["BlacklistedPorts"])
+    black_rules = rule_evaluator.uncompliant_permissions(configuration_item['configuration']['ipPermissions'], blacklist)
     if black_rules:
         return build_evaluation_from_config_item(configuration_item, 'NON_COMPLIANT', annotation=str(black_rules))
     return build_evaluation_from_config_item(configuration_item, 'COMPLIANT', annotation='This security group has no blacklisted ingress rules.')
@@ -50,23 +59,6 @@ def evaluate_compliance(event, configuration_item, valid_rule_parameters):
     # Add your custom logic here. #
     ###############################
 
-def check_portrange(inbound_rule, blacklist_ports):
-    hit = None
-    fromport = inbound_rule.get("fromPort")
-    toport = inbound_rule.get("toPort")
-    if fromport:
-        for port in blacklist_ports:
-            if fromport < port < toport:
-                hit = port
-    return hit
-
-def check_singleport(inbound_rule, blacklist_ports):
-    hit = None
-    for port in blacklist_ports:
-        if inbound_rule["fromPort"] == inbound_rule["toPort"] == port:
-            hit = inbound_rule["fromPort"]
-    return hit
-
 def evaluate_parameters(rule_parameters):
     try:
         if rule_parameters["BlacklistedPorts"] != "" and isinstance(rule_parameters["BlacklistedPorts"], str):
@@ -103,13 +95,8 @@ def get_client(service, event, region=None):
     region -- the region where the client is called (default: None)
     """
     if not ASSUME_ROLE_MODE:
-        return boto3.client(service, region)
-    credentials = get_assume_role_credentials(get_execution_role_arn(event), region)
-    return boto3.client(service, aws_access_key_id=credentials['AccessKeyId'],
-                        aws_secret_access_key=credentials['SecretAccessKey'],
-                        aws_session_token=credentials['SessionToken'],
-                        region_name=region
-                       )
+        return CLIENT_POOL.get_client(service, region=region)
+    return CLIENT_POOL.get_client(service, get_execution_role_arn(event), region)
 
 # This generate an evaluation for config
 def build_evaluation(resource_id, compliance_type, event, resource_type=DEFAULT_RESOURCE_TYPE, annotation=None):
@@ -188,7 +175,10 @@ def is_scheduled_notification(message_type):
     return message_type == 'ScheduledNotification'
 
 # Get configurationItem using getResourceConfigHistory API
-# in case of OversizedConfigurationItemChangeNotification
+# in case of OversizedConfigurationItemChangeNotification.
+# Memoized per (resourceType, resourceId, captureTime): the returned item is shared
+# between invocations and must not be modified. Hits and misses are in get_configuration.cache_info().
+@functools.lru_cache(maxsize=CONFIGURATION_CACHE_SIZE)
 def get_configuration(resource_type, resource_id, configuration_capture_time):
     result = AWS_CONFIG_CLIENT.get_resource_config_history(
         resourceType=resource_type,
@@ -220,7 +210,9 @@ def get_configuration_item(invoking_event):
     check_defined(invoking_event, 'invokingEvent')
     if is_oversized_changed_notification(invoking_event['messageType']):
         configuration_item_summary = check_defined(invoking_event['configurationItemSummary'], 'configurationItemSummary')
-        return get_configuration(configuration_item_summary['resourceType'], configuration_item_summary['resourceId'], configuration_item_summary['configurationItemCaptureTime'])
+        configuration_item = get_configuration(configuration_item_summary['resourceType'], configuration_item_summary['resourceId'], configuration_item_summary['configurationItemCaptureTime'])
+        print("get_configuration cache: " + str(get_configuration.cache_info()))
+        return configuration_item
     if is_scheduled_notification(invoking_event['messageType']):
         return None
     return check_defined(invoking_event['configurationItem'], 'configurationItem')
@@ -259,42 +251,63 @@ def get_assume_role_credentials(role_arn, region=None):
             ex.response['Error']['Code'] = "InternalError"
         raise ex
 
+# Stream the old evaluations of the rule page by page.
+def iter_old_evaluations(event):
+    paginator = AWS_CONFIG_CLIENT.get_paginator('get_compliance_details_by_config_rule')
+    for page in paginator.paginate(ConfigRuleName=event['configRuleName'],
+                                   ComplianceTypes=['COMPLIANT', 'NON_COMPLIANT'],
+                                   PaginationConfig={'PageSize': 100}):
+        yield from page['EvaluationResults']
+
 # This removes older evaluation (usually useful for periodic rule not reporting on AWS::::Account).
 def clean_up_old_evaluations(latest_evaluations, event):
 
     cleaned_evaluations = []
+    latest_resource_ids = {latest_eval['ComplianceResourceId'] for latest_eval in latest_evaluations}
 
-    old_eval = AWS_CONFIG_CLIENT.get_compliance_details_by_config_rule(
-        ConfigRuleName=event['configRuleName'],
-        ComplianceTypes=['COMPLIANT', 'NON_COMPLIANT'],
-        Limit=100)
-
-    old_eval_list = []
-
-    while True:
-        for old_result in old_eval['EvaluationResults']:
-            old_eval_list.append(old_result)
-        if 'NextToken' in old_eval:
-            next_token = old_eval['NextToken']
-            old_eval = AWS_CONFIG_CLIENT.get_compliance_details_by_config_rule(
-                ConfigRuleName=event['configRuleName'],
-                ComplianceTypes=['COMPLIANT', 'NON_COMPLIANT'],
-                Limit=100,
-                NextToken=next_token)
-        else:
-            break
-
-    for old_eval in old_eval_list:
+    for old_eval in iter_old_evaluations(event):
         old_resource_id = old_eval['EvaluationResultIdentifier']['EvaluationResultQualifier']['ResourceId']
-        newer_founded = False
-        for latest_eval in latest_evaluations:
-            if old_resource_id == latest_eval['ComplianceResourceId']:
-                newer_founded = True
-        if not newer_founded:
+        if old_resource_id not in latest_resource_ids:
             cleaned_evaluations.append(build_evaluation(old_resource_id, "NOT_APPLICABLE", event))
 
     return cleaned_evaluations + latest_evaluations
 
+class RetryBudget:
+    """Thread safe counter of the retries left for one invocation."""
+    def __init__(self, retries):
+        self.retries = retries
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.retries <= 0:
+                return False
+            self.retries -= 1
+            return True
+
+def put_evaluations_batch(batch, result_token, test_mode, budget):
+    attempt = 0
+    while True:
+        try:
+            response = AWS_CONFIG_CLIENT.put_evaluations(Evaluations=batch, ResultToken=result_token, TestMode=test_mode)
+            return response.get('FailedEvaluations', [])
+        except botocore.exceptions.ClientError as ex:
+            if not remediation.is_throttling_error(ex) or not budget.take():
+                raise
+            time.sleep(remediation.backoff_delay(attempt))
+            attempt += 1
+
+# Invoke the Config API to report the evaluations, in concurrent batches of 100 sharing one retry budget.
+def put_evaluations(evaluations, result_token, test_mode=False):
+    budget = RetryBudget(PUT_EVALUATIONS_RETRY_BUDGET)
+    batches = [evaluations[i:i + PUT_EVALUATIONS_BATCH_SIZE] for i in range(0, len(evaluations), PUT_EVALUATIONS_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=PUT_EVALUATIONS_WORKERS) as pool:
+        futures = [pool.submit(put_evaluations_batch, batch, result_token, test_mode, budget) for batch in batches]
+        failed_evaluations = [failed for future in futures for failed in future.result()]
+    if failed_evaluations:
+        print("Failed evaluations: " + str(failed_evaluations))
+    return failed_evaluations
+
 def lambda_handler(event, context):
     if 'liblogging' in sys.modules:
         liblogging.logEvent(event)
@@ -371,11 +384,7 @@ def lambda_handler(event, context):
         test_mode = True
 
     # Invoke the Config API to report the result of the evaluation
-    evaluation_copy = []
-    evaluation_copy = evaluations[:]
-    while evaluation_copy:
-        AWS_CONFIG_CLIENT.put_evaluations(Evaluations=evaluation_copy[:100], ResultToken=result_token, TestMode=test_mode)
-        del evaluation_copy[:100]
+    put_evaluations(evaluations, result_token, test_mode)
 
     # Used solely for RDK test to be able to test Lambda function
     return evaluations
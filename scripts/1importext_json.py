@@ -1,11 +1,8 @@
-import json
-import sys
-f = open ("namefile.json", "r")
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
 
-data = json.load(f)
-unique = {each['id'] : each for each in data ['vulnerabilities']}.values()
-severity = [{'severity': item['severity'], 'id' : item ['id'], 'exploit': item ['exploit']} for item in unique]
-print(severity)
-for item in severity:
-    if item['exploit'] == 'Functional' and item['severity'] != 'medium':
-        sys.exit(1)
\ No newline at end of file
+# Kept for the pipelines that still call this name, the gate lives in importext_json.py
+import os
+import runpy
+
+runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'importext_json.py'), run_name='__main__')
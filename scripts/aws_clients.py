@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
+
+# Shared pool of boto3 sessions and clients for the S3 Lambdas (copyfile, encrypt,
+# decrypt and sftp). Sessions and clients are built lazily the first time they
+# are asked for, cached per service/region at module level and reused by every
+# warm invocation of the container.
+
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+DEFAULT_REGION = 'us-east-1'
+
+#Throttled requests (SlowDown, Throttling...) are retried with client side rate limiting
+config = Config(
+    retries = dict(
+        max_attempts = 10,
+        mode = 'adaptive'
+    )
+)
+
+_sessions = {}
+_clients = {}
+_lock = threading.Lock()
+_stats = {'sessions_created': 0, 'clients_created': 0, 'clients_reused': 0, 'init_seconds': 0.0}
+
+
+def get_session(region=DEFAULT_REGION):
+    with _lock:
+        if region not in _sessions:
+            start = time.perf_counter()
+            _sessions[region] = boto3.session.Session(region_name=region)
+            _stats['sessions_created'] += 1
+            _stats['init_seconds'] += time.perf_counter() - start
+        return _sessions[region]
+
+
+def get_client(service, region=DEFAULT_REGION, max_pool_connections=None):
+    # boto3 clients are thread safe, one client per service/region is shared by all the callers.
+    # Callers running more concurrent requests than the default pool of 10 connections
+    # ask for a larger max_pool_connections and get a client of their own.
+    key = (service, region, max_pool_connections)
+    with _lock:
+        if key in _clients:
+            _stats['clients_reused'] += 1
+            return _clients[key]
+    session = get_session(region)
+    with _lock:
+        if key not in _clients:
+            start = time.perf_counter()
+            client_config = config
+            if max_pool_connections:
+                client_config = config.merge(Config(max_pool_connections=max_pool_connections))
+            _clients[key] = session.client(service, config=client_config)
+            _stats['clients_created'] += 1
+            _stats['init_seconds'] += time.perf_counter() - start
+        return _clients[key]
+
+
+def stats():
+    # Returns a copy of the counters: sessions/clients created, clients reused and the time spent creating them
+    with _lock:
+        return dict(_stats)
+
+
+def print_stats():
+    current = stats()
+    print(f"aws_clients: {current['sessions_created']} sessions and {current['clients_created']} clients created "
+          f"in {current['init_seconds'] * 1000:.1f} ms, {current['clients_reused']} reuses")
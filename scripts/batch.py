@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
+
+# Multi-record processing for the S3 triggered Lambdas. Handles S3 notifications
+# delivered directly (event['Records'] are S3 records) or through SQS (every
+# record body is an S3 notification). Every S3 record is processed by a bounded
+# worker pool. Through SQS the result is returned in the partial batch response
+# format, so one bad file does not make the whole batch retry. Direct S3
+# invocations are asynchronous and ignore that format, so a failure raises and
+# Lambda retries the event / sends it to the on-failure destination.
+
+import json
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 4
+
+
+def parse_s3_records(event):
+    # Returns ([(item identifier, bucket, key)], [messageId]) for the S3 objects of the
+    # event and the SQS messages whose body could not be parsed. The identifier is the
+    # SQS messageId, or bucket/key for direct S3 events. Every SQS message is parsed on
+    # its own so a malformed one only fails itself, a malformed direct S3 record raises.
+    records = []
+    malformed = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            try:
+                body = json.loads(record['body'])
+                #s3:TestEvent messages have no Records
+                s3_records = [(s3_record['s3']['bucket']['name'], _key(s3_record))
+                              for s3_record in body.get('Records', [])]
+            except (KeyError, TypeError, AttributeError, ValueError) as e:
+                print(f"Malformed message {record.get('messageId')}: {type(e).__name__}: {e}")
+                malformed.append(record['messageId'])
+                continue
+            records.extend((record['messageId'], bucket, key) for bucket, key in s3_records)
+        else:
+            bucket = record['s3']['bucket']['name']
+            key = _key(record)
+            records.append((f"{bucket}/{key}", bucket, key))
+    return records, malformed
+
+
+def iter_s3_records(event):
+    # Yields (item identifier, bucket, key) for every S3 object of the event, skipping
+    # the malformed SQS messages (see parse_s3_records)
+    yield from parse_s3_records(event)[0]
+
+
+def _key(s3_record):
+    return urllib.parse.unquote_plus(s3_record['s3']['object']['key'], encoding='utf-8')
+
+
+class BatchFailure(Exception):
+
+    def __init__(self, failed):
+        super().__init__(f"{len(failed)} objects failed: {', '.join(failed)}")
+        self.failed = failed
+
+
+def is_sqs_event(event):
+    return any(record.get('eventSource') == 'aws:sqs' for record in event.get('Records', []))
+
+
+def batch_response(event, records, errors, malformed=()):
+    # records are the (identifier, bucket, key) of parse_s3_records and errors the
+    # exception (or None) of each one, malformed the messageIds that could not be
+    # parsed. Returns the SQS partial batch response, or raises BatchFailure when the
+    # event came directly from S3 and something failed.
+    failed = list(malformed)
+    for (identifier, bucket, key), error in zip(records, errors):
+        if error is not None and identifier not in failed:
+            failed.append(identifier)
+    print(f"Processed {len(records)} objects, {len(records) - sum(error is not None for error in errors)} ok, "
+          f"{len(malformed)} malformed messages, {len(failed)} failed items")
+    if failed and not is_sqs_event(event):
+        raise BatchFailure(failed)
+    return {'batchItemFailures': [{'itemIdentifier': identifier} for identifier in failed]}
+
+
+def _run(process_object, bucket, key):
+    try:
+        process_object(bucket, key)
+        return None
+    except Exception as e:
+        print(f"Failed processing {bucket}/{key}: {e}")
+        return e
+
+
+def process_records(event, process_object, max_workers=MAX_WORKERS):
+    # Calls process_object(bucket, key) for every S3 object of the event and
+    # returns {'batchItemFailures': [{'itemIdentifier': ...}]}. A message fails
+    # when any of its objects fails or its body cannot be parsed. See batch_response
+    # for direct S3 events.
+    try:
+        records, malformed = parse_s3_records(event)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Malformed event: {e}")
+        raise
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        errors = list(pool.map(lambda record: _run(process_object, record[1], record[2]), records))
+    return batch_response(event, records, errors, malformed)
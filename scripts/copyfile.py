@@ -1,41 +1,135 @@
 #!/usr/bin/env python
 #-*- encoding: utf-8 -*-
 
-import boto3
-import botocore
+import argparse
+import botocore.exceptions
 import os
 import json
-import urllib
+import threading
+import time
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 
-        
-def S3_copy_file(src_bucket,src_key,dst_bucket,dst_key):
-    
-    session = boto3.session.Session(region_name='us-east-1')
-    s3 = session.resource('s3')
+import aws_clients
+import batch
+
+MB = 1024 * 1024
+
+#Objects above the threshold are copied server side in parts (UploadPartCopy),
+#throttled parts are retried by the adaptive retry mode of aws_clients
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.environ.get('multipart_threshold_mb', 64)) * MB,
+    multipart_chunksize=int(os.environ.get('multipart_chunksize_mb', 64)) * MB,
+    max_concurrency=int(os.environ.get('max_concurrency', 10)),
+)
+#Objects copied at the same time by the bulk mode
+BULK_WORKERS = 16
+#Connections of a botocore client pool by default
+DEFAULT_POOL_CONNECTIONS = 10
+
+
+class Progress:
+    # Thread safe byte counter used as transfer Callback
+    def __init__(self):
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self.lock:
+            self.bytes += bytes_amount
+
+
+def copy_client(config=TRANSFER_CONFIG, workers=1):
+    # Every part copied at the same time holds a connection, the pool of the client
+    # must hold the max_concurrency parts of each of the objects copied at the same time
+    connections = workers * config.max_concurrency
+    return aws_clients.get_client('s3', max_pool_connections=connections if connections > DEFAULT_POOL_CONNECTIONS else None)
+
+
+def S3_copy_file(src_bucket,src_key,dst_bucket,dst_key,config=TRANSFER_CONFIG,progress=None,s3=None):
+    # Returns the number of bytes copied, 0 if the object does not exist
+    s3 = s3 or copy_client(config)
     copy_source = {
       'Bucket': f'{src_bucket}',
       'Key': f'{src_key}'
         }
+    progress = progress or Progress()
+    start = time.perf_counter()
     try:
-        bucket = s3.Bucket(dst_bucket)
-        bucket.copy(copy_source, dst_key) 
+        s3.copy(copy_source, dst_bucket, dst_key, Config=config, Callback=progress)
     except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
+        code = e.response['Error']['Code']
+        if code in ("404", "NoSuchKey"):
             print("The object does not exist.")
-        else:
-            raise
+            return 0
+        if code in ("403", "AccessDenied"):
+            print(f"Access denied copying {src_bucket}/{src_key} to {dst_bucket}/{dst_key}")
+        raise
+    seconds = time.perf_counter() - start
+    print(f"Copied {progress.bytes} bytes in {seconds:.2f}s ({progress.bytes / MB / seconds if seconds else 0:.1f} MB/s)")
+    return progress.bytes
 
 
-def lambda_handler(event,context):
-    
-    print("Received event: " + json.dumps(event, indent=2))
-    src_bucket = event['Records'][0]['s3']['bucket']['name']
-    src_key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-    environment = os.environ['environment']
+def datalake_destination(src_bucket, src_key, environment):
     dst_bucket = f"uala-col-integrator-datalake-{environment}"
     provider_name = src_bucket.split("-")[-2]
     file_name = src_key.split("/")[-1]
     dst_key  = f"{provider_name}/{file_name}"
+    return dst_bucket, dst_key
+
+
+def S3_copy_prefix(src_bucket, prefix, environment, workers=BULK_WORKERS, config=TRANSFER_CONFIG):
+    # Bulk mode: copies every object under prefix to the datalake layout with many
+    # concurrent copies. Returns (objects copied, failed keys, bytes copied).
+    s3 = copy_client(config, workers)
+    paginator = s3.get_paginator('list_objects_v2')
+    #bytes of all the objects, each copy counts its own object
+    total = Progress()
+    failed = []
+
+    def copy(key):
+        dst_bucket, dst_key = datalake_destination(src_bucket, key, environment)
+        try:
+            total(S3_copy_file(src_bucket, key, dst_bucket, dst_key, config, s3=s3))
+            return True
+        except Exception as e:
+            print(f"Failed copying {key}: {e}")
+            failed.append(key)
+            return False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        keys = (obj['Key'] for page in paginator.paginate(Bucket=src_bucket, Prefix=prefix)
+                for obj in page.get('Contents', []) if not obj['Key'].endswith('/'))
+        copied = sum(pool.map(copy, keys))
+    seconds = time.perf_counter() - start
+    print(f"Bulk copy of {src_bucket}/{prefix}: {copied} objects, {len(failed)} failed, "
+          f"{total.bytes} bytes in {seconds:.2f}s ({total.bytes / MB / seconds if seconds else 0:.1f} MB/s)")
+    return copied, failed, total.bytes
+
+
+def process_object(src_bucket, src_key):
+    environment = os.environ['environment']
+    dst_bucket, dst_key = datalake_destination(src_bucket, src_key, environment)
  
     print(f"Copying unencrypted file from bucket: {src_bucket} to: {dst_bucket}")
     S3_copy_file(src_bucket,src_key,dst_bucket,dst_key)
+
+def lambda_handler(event, context):
+    
+    print("Received event: " + json.dumps(event, indent=2))
+    response = batch.process_records(event, process_object)
+    aws_clients.print_stats()
+    return response
+
+
+if __name__ == "__main__":
+    #Backfill of a provider's history, e.g. python copyfile.py --src-bucket my-provider-in --prefix 2023/ --environment dev
+    parser = argparse.ArgumentParser(description='Bulk copy of a source prefix to the datalake')
+    parser.add_argument("--src-bucket", type=str, required=True, help="Source bucket")
+    parser.add_argument("--prefix", type=str, default="", help="Source prefix to copy")
+    parser.add_argument("--environment", type=str, required=True, help="Datalake environment")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="Objects copied at the same time")
+    args = parser.parse_args()
+    copied, failed, _ = S3_copy_prefix(args.src_bucket, args.prefix, args.environment, args.workers)
+    raise SystemExit(1 if failed else 0)
@@ -1,46 +1,62 @@
 #!/usr/bin/env python
 #-*- encoding: utf-8 -*-
 
-import boto3
-import botocore
+import botocore.exceptions
 import gnupg
 import os
 import sys
 import json
-import urllib
 from pprint import pprint
 
+import aws_clients
+import batch
+import s3_stream
+import secret_cache
+
+
+_gpg = None
+
+def get_gpg():
+    # One GPG instance (and keyring in /tmp/) per container, reused by warm invocations
+    global _gpg
+    if _gpg is None:
+        _gpg = gnupg.GPG(gnupghome='/tmp/')
+    return _gpg
 
-def get_secret():
-    secret_name=os.environ['secret_name']
-    client = boto3.client(service_name= 'secretsmanager',region_name= 'us-east-1')
-    credentials = client.get_secret_value(SecretId=secret_name)
-    return credentials['SecretString']
-   
 def import_key():
-    gpg = gnupg.GPG(gnupghome='/tmp/')
-    key_data = get_secret()
-    import_result = gpg.import_keys(f'''{key_data}''')
-    pprint(import_result.results)
+    # Only imports on cold start or when the secret was rotated
+    fingerprints = secret_cache.import_key(get_gpg(), os.environ['secret_name'])
+    pprint(fingerprints)
 
 def encrypt_file(local_file):
     
     INPUT=local_file
     OUTPUT=local_file.split(".")[0]
     gpg_key_id=os.environ['gpg_key_id']
-    gpg = gnupg.GPG(gnupghome='/tmp/')
+    gpg = get_gpg()
     with open(f"/tmp/{INPUT}", 'rb') as f:
         status = gpg.encrypt_file(f, recipients=[f'{gpg_key_id}'], output=f"/tmp/{OUTPUT}.txt.gpg",always_trust=True)
         print ('ok: ', status.ok)
         print ('status: ', status.status)
         print ('stderr: ', status.stderr)
         
+def S3_encrypt_stream(bucket_name, bucket_key_name, object_name):
+    # Pipes the S3 object through gpg straight into a multipart upload, no /tmp staging
+    gpg_key_id=os.environ['gpg_key_id']
+    gpg = get_gpg()
+    command = [gpg.gpgbinary, '--homedir', gpg.gnupghome, '--batch', '--yes', '--no-tty',
+               '--trust-model', 'always', '--encrypt', '--recipient', gpg_key_id, '--output', '-']
+    stats = s3_stream.pipe_s3_object(command, bucket_name, bucket_key_name, bucket_name, object_name,
+                                     part_size=int(os.environ.get('part_size', s3_stream.PART_SIZE)))
+    print(f"Encrypted {stats['bytes_in']} bytes into {stats['bytes_out']} bytes ({stats['parts']} parts) in {stats['seconds']:.2f}s, "
+          f"{stats['mb_per_s']:.1f} MB/s, peak RSS {stats['peak_rss_mb']:.0f} MB")
+    return stats
+
 def S3_download_file(bucket_name,bucket_key_name,local_file):
     
-    session = boto3.session.Session(region_name='us-east-1')
-    s3 = session.resource('s3')
+    s3 = aws_clients.get_client('s3')
     try:
-        s3.Bucket(bucket_name).download_file(bucket_key_name, '/tmp/' f'{local_file}') 
+        s3.download_file(bucket_name, bucket_key_name, '/tmp/' f'{local_file}')
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             print("The object does not exist.")
@@ -53,31 +69,41 @@ def S3_upload_file(file_name, bucket, object_name):
     if object_name is None:
         object_name = file_name
     # Upload the file
-    session = boto3.session.Session(region_name='us-east-1')
-    s3_client = session.client('s3')
+    s3_client = aws_clients.get_client('s3')
     try:
         response = s3_client.upload_file(file_name, bucket, object_name)
-    except ClientError as e:
-        logging.error(e)
+    except botocore.exceptions.ClientError as e:
+        print(e)
         return False
     return True 
 
-def lambda_handler(event, context):
-    
-    print("Received event: " + json.dumps(event, indent=2))
-    bucket_name = event['Records'][0]['s3']['bucket']['name']
-    bucket_key_name = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+def process_object(bucket_name, bucket_key_name):
     local_file = bucket_key_name.split("/")[-1]
     basename_file = local_file.split(".")[0]
     dst_prefix = os.environ['dst_prefix']
     file_to_upload = f"/tmp/{basename_file}.txt.gpg"
     object_name = f"{dst_prefix}/{basename_file}.txt.gpg"
  
-    print(f"Downloading unecrypted file from bucket: {bucket_name} and key: {bucket_key_name} ")
-    S3_download_file(bucket_name,bucket_key_name,local_file)
-    print("Importing private key")
-    import_key()
-    print(f"Encrypting file {basename_file}.txt")
-    encrypt_file(local_file)
-    print(f"Uploading encrypted file to bucket: {bucket_name} in {object_name}")
-    S3_upload_file(file_to_upload,bucket_name,object_name)
+    if os.environ.get('streaming', 'true').lower() == 'true':
+        print("Importing private key")
+        import_key()
+        print(f"Streaming encryption of {bucket_name}/{bucket_key_name} to {object_name}")
+        S3_encrypt_stream(bucket_name, bucket_key_name, object_name)
+    else:
+        print(f"Downloading unecrypted file from bucket: {bucket_name} and key: {bucket_key_name} ")
+        S3_download_file(bucket_name,bucket_key_name,local_file)
+        print("Importing private key")
+        import_key()
+        print(f"Encrypting file {basename_file}.txt")
+        encrypt_file(local_file)
+        print(f"Uploading encrypted file to bucket: {bucket_name} in {object_name}")
+        if not S3_upload_file(file_to_upload,bucket_name,object_name):
+            raise RuntimeError(f"Upload of {object_name} failed")
+
+def lambda_handler(event, context):
+    
+    print("Received event: " + json.dumps(event, indent=2))
+    response = batch.process_records(event, process_object)
+    aws_clients.print_stats()
+    print(f"secret_cache: {secret_cache.stats()}")
+    return response
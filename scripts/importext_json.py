@@ -1,11 +1,77 @@
+import argparse
 import json
 import sys
-f = open ("namefile.json", "r")
-
-data = json.load(f)
-unique = {each['id'] : each for each in data ['vulnerabilities']}.values()
-severity = [{'severity': item['severity'], 'id' : item ['id'], 'exploit': item ['exploit']} for item in unique]
-print(severity)
-for item in severity:
-    if item['exploit'] == 'Functional' and item['severity'] != 'medium':
+
+import vuln_baseline
+import vuln_policy
+import vuln_stream
+
+
+def is_blocking(item):
+    return item['exploit'] == 'Functional' and item['severity'] != 'medium'
+
+
+def gate(path):
+    f = open (path, "r")
+
+    data = json.load(f)
+    unique = {each['id'] : each for each in data ['vulnerabilities']}.values()
+    severity = [{'severity': item['severity'], 'id' : item ['id'], 'exploit': item ['exploit']} for item in unique]
+    print(severity)
+    for item in severity:
+        if is_blocking(item):
+            sys.exit(1)
+
+
+def stream_gate(path):
+    # Streams the report and stops at the first blocking finding, memory does not grow with the report size
+    #every occurrence is checked, the ids seen only deduplicate the output
+    seen = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for item in vuln_stream.iter_vulnerabilities(f):
+            if item['id'] not in seen:
+                seen.add(item['id'])
+                print({'severity': item['severity'], 'id' : item ['id'], 'exploit': item ['exploit']})
+            if is_blocking(item):
+                print(f"Blocking finding: {item['id']}")
+                sys.exit(1)
+
+
+def policy_gate(paths, policy_path=None, workers=vuln_policy.MAX_WORKERS, json_path=None, junit_path=None,
+                baseline_path=None):
+    # Evaluates every report against the policy in one invocation and writes the merged result
+    policy = vuln_policy.Policy.from_file(policy_path) if policy_path else vuln_policy.Policy()
+    merged = vuln_policy.evaluate_reports(paths, policy, workers, baseline_path)
+    for result in merged['results']:
+        status = f"error: {result['error']}" if result['error'] else f"{len(result['blocking'])} blocking"
+        delta = (f", {result['new']} new, {result['changed']} changed, {result['unchanged']} unchanged, {result['fixed']} fixed"
+                 if 'new' in result else "")
+        print(f"{result['report']}: {result['findings']} findings{delta}, {result['allowed']} allowed, {status}")
+    if json_path:
+        vuln_policy.write_json(merged, json_path)
+    if junit_path:
+        vuln_policy.write_junit(merged, junit_path)
+    print(f"{merged['reports']} reports, {merged['blocking']} blocking findings, {merged['errors']} errors")
+    if not merged['passed']:
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fails when the report has a blocking vulnerability')
+    parser.add_argument("reports", nargs="*", default=["namefile.json"], help="Scanner reports (snyk test --json)")
+    parser.add_argument("--stream", action="store_true", help="Parse the report incrementally and exit at the first blocking finding")
+    parser.add_argument("--policy", type=str, help="Rules file, see vuln_policy.py (default: the historical rule)")
+    parser.add_argument("--workers", type=int, default=vuln_policy.MAX_WORKERS, help="Reports evaluated at the same time")
+    parser.add_argument("--json", type=str, help="Write the merged result as JSON")
+    parser.add_argument("--junit", type=str, help="Write the merged result as JUnit XML")
+    parser.add_argument("--baseline", action="store_true",
+                        help="Only evaluate findings new or changed since the baseline index (updated when a report passes)")
+    parser.add_argument("--baseline-path", type=str, default=vuln_baseline.BASELINE_PATH, help="Baseline index (SQLite)")
+    args = parser.parse_args()
+    if args.policy or args.json or args.junit or args.baseline or len(args.reports) > 1:
+        policy_gate(args.reports, args.policy, args.workers, args.json, args.junit,
+                    args.baseline_path if args.baseline else None)
+    elif args.stream:
+        stream_gate(args.reports[0])
+    else:
+        gate(args.reports[0])
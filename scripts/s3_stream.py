@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
+
+# Streaming helpers for the S3 Lambdas: an S3 multipart writer that uploads
+# parts concurrently as they fill, a pipe that runs a command (e.g. gpg)
+# between an S3 GetObject body and that writer, and a read-ahead reader that
+# file consumers read() from (e.g. sftp.stream_object, which writes it to the
+# remote file opened with s.open()). Nothing is staged in
+# /tmp and memory is bounded by part_size * (max_in_flight + 1), or buffer_size
+# for the reader.
+
+import queue
+import resource
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+
+#S3 needs at least 5 MiB per part (except the last one) and at most 10,000 parts
+PART_SIZE = 16 * 1024 * 1024
+MAX_IN_FLIGHT = 4
+READ_SIZE = 1024 * 1024
+#Read-ahead of S3Reader
+BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class MultipartWriter:
+
+    def __init__(self, bucket, key, part_size=PART_SIZE, max_in_flight=MAX_IN_FLIGHT, s3=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.s3 = s3 or aws_clients.get_client('s3')
+        self.upload_id = self.s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.buffer = bytearray()
+        self.parts = []
+        self.futures = []
+        self.bytes_written = 0
+        #first failed part, raised by the next write() instead of at close()
+        self.error = None
+        self.pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        #blocks write() when max_in_flight parts are already uploading, bounds the memory
+        self.slots = threading.Semaphore(max_in_flight)
+
+    def _upload_part(self, number, data):
+        try:
+            response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=bytes(data))
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        except Exception as e:
+            self.error = self.error or e
+            raise
+        finally:
+            self.slots.release()
+
+    def _check(self):
+        if self.error:
+            raise self.error
+
+    def _submit(self, data):
+        self._check()
+        self.slots.acquire()
+        try:
+            self._check()
+        except Exception:
+            self.slots.release()
+            raise
+        number = len(self.futures) + 1
+        self.futures.append(self.pool.submit(self._upload_part, number, data))
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._submit(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+
+    def close(self):
+        # Uploads the last part and completes the upload, the last part may be empty
+        if self.buffer or not self.futures:
+            self._submit(self.buffer)
+            self.buffer = bytearray()
+        self.parts = [future.result() for future in self.futures]
+        self.pool.shutdown()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class S3Reader:
+    # File-like reader over an S3 object. A background thread downloads read_size
+    # chunks into a buffer of at most buffer_size bytes, so the download overlaps
+    # with whatever consumes read(). Reading starts at offset (ranged GetObject),
+    # if_match pins the object version (PreconditionFailed if it was overwritten).
+
+    def __init__(self, bucket, key, offset=0, buffer_size=BUFFER_SIZE, read_size=READ_SIZE, s3=None, if_match=None):
+        s3 = s3 or aws_clients.get_client('s3')
+        self.start = time.perf_counter()
+        kwargs = {'Range': f'bytes={offset}-'} if offset else {}
+        if if_match:
+            kwargs['IfMatch'] = if_match
+        response = s3.get_object(Bucket=bucket, Key=key, **kwargs)
+        self.size = response['ContentLength']
+        self.body = response['Body']
+        self.read_size = read_size
+        self.ttfb = None
+        self.bytes_read = 0
+        self.pending = b''
+        self.position = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.chunks = queue.Queue(maxsize=max(1, buffer_size // read_size))
+        self.thread = threading.Thread(target=self._download, daemon=True)
+        self.thread.start()
+
+    def _download(self):
+        try:
+            while not self.closed:
+                chunk = self.body.read(self.read_size)
+                if self.ttfb is None:
+                    self.ttfb = time.perf_counter() - self.start
+                if not chunk:
+                    break
+                self.chunks.put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.chunks.put(None)
+
+    def read(self, size=-1):
+        parts = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self.position >= len(self.pending):
+                if self.done:
+                    break
+                chunk = self.chunks.get()
+                if chunk is None:
+                    self.done = True
+                    if self.error:
+                        raise self.error
+                    break
+                self.pending, self.position = chunk, 0
+            end = len(self.pending) if size < 0 else min(len(self.pending), self.position + wanted)
+            parts.append(self.pending[self.position:end])
+            wanted -= end - self.position
+            self.position = end
+        result = b''.join(parts)
+        self.bytes_read += len(result)
+        return result
+
+    def close(self):
+        # Stops the download thread, which may be blocked on a full buffer
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.body.close()
+
+    def stats(self):
+        seconds = time.perf_counter() - self.start
+        return {'bytes': self.bytes_read, 'seconds': seconds, 'ttfb': self.ttfb,
+                'mb_per_s': self.bytes_read / 1024 / 1024 / seconds if seconds else 0.0}
+
+
+def peak_rss_mb():
+    # Peak resident memory of the process (ru_maxrss is in KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _feed(body, stdin, read_size, counters, errors):
+    try:
+        while True:
+            chunk = body.read(read_size)
+            if not chunk:
+                break
+            counters['bytes_in'] += len(chunk)
+            stdin.write(chunk)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def pipe_s3_object(command, src_bucket, src_key, dst_bucket, dst_key, part_size=PART_SIZE,
+                   max_in_flight=MAX_IN_FLIGHT, read_size=READ_SIZE):
+    # Runs command with the source object on stdin and uploads its stdout as the
+    # destination object. Download, command and upload overlap. Returns the
+    # transfer stats (bytes_in, bytes_out, parts, seconds, mb_per_s, peak_rss_mb).
+    start = time.perf_counter()
+    s3 = aws_clients.get_client('s3')
+    body = s3.get_object(Bucket=src_bucket, Key=src_key)['Body']
+    writer = MultipartWriter(dst_bucket, dst_key, part_size, max_in_flight, s3)
+    process = None
+    counters = {'bytes_in': 0}
+    errors = []
+    stderr = []
+    try:
+        #inside the try so a command that cannot start still aborts the multipart upload
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        feeder = threading.Thread(target=_feed, args=(body, process.stdin, read_size, counters, errors), daemon=True)
+        reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        feeder.start()
+        reader.start()
+        while True:
+            chunk = process.stdout.read(read_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+        returncode = process.wait()
+        feeder.join()
+        reader.join()
+        if returncode != 0:
+            raise RuntimeError(f"{command[0]} exited with {returncode}: {b''.join(stderr).decode(errors='replace')}")
+        if errors:
+            raise errors[0]
+        writer.close()
+    except Exception:
+        if process:
+            process.kill()
+        else:
+            body.close()
+        writer.abort()
+        raise
+    seconds = time.perf_counter() - start
+    return {'bytes_in': counters['bytes_in'], 'bytes_out': writer.bytes_written,
+            'parts': len(writer.parts), 'seconds': seconds,
+            'mb_per_s': counters['bytes_in'] / 1024 / 1024 / seconds if seconds else 0.0,
+            'peak_rss_mb': peak_rss_mb()}
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
+
+# In-process cache of Secrets Manager values for the S3 Lambdas. Secrets are
+# kept at module level for SECRET_TTL seconds, so warm invocations neither call
+# Secrets Manager nor re-import GPG keys / rewrite PEM files unless the secret
+# was rotated.
+
+import hashlib
+import os
+import threading
+import time
+
+import aws_clients
+
+SECRET_TTL = 900
+
+_secrets = {}
+#secret_name -> (secret hash, fingerprints imported from it)
+_imported_keys = {}
+#path -> hash of the secret written to it
+_written_files = {}
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'imports': 0, 'imports_skipped': 0}
+
+
+def _digest(value):
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def get_secret(secret_name, ttl=SECRET_TTL):
+    # Returns the SecretString, from the cache if it was fetched less than ttl seconds ago
+    with _lock:
+        cached = _secrets.get(secret_name)
+        if cached and time.monotonic() - cached[1] < ttl:
+            _stats['hits'] += 1
+            return cached[0]
+    client = aws_clients.get_client('secretsmanager')
+    value = client.get_secret_value(SecretId=secret_name)['SecretString']
+    with _lock:
+        _secrets[secret_name] = (value, time.monotonic())
+        _stats['misses'] += 1
+    return value
+
+
+def import_key(gpg, secret_name):
+    # Imports the key stored in secret_name into the gpg keyring, unless the same
+    # secret was already imported and all its fingerprints are still in the keyring.
+    # Returns the fingerprints of the key.
+    key_data = get_secret(secret_name)
+    digest = _digest(key_data)
+    with _lock:
+        imported = _imported_keys.get(secret_name)
+    if imported and imported[0] == digest:
+        keyring = {key['fingerprint'] for key in gpg.list_keys()}
+        if set(imported[1]) <= keyring:
+            with _lock:
+                _stats['imports_skipped'] += 1
+            return imported[1]
+    import_result = gpg.import_keys(key_data)
+    fingerprints = [fingerprint for fingerprint in import_result.fingerprints if fingerprint]
+    #only a successful import is remembered, a failed one is retried on the next call
+    if not import_result.count or not fingerprints:
+        raise RuntimeError(f"Could not import the key of {secret_name}: {import_result.results}")
+    with _lock:
+        _imported_keys[secret_name] = (digest, fingerprints)
+        _stats['imports'] += 1
+    return fingerprints
+
+
+def write_secret_file(secret_name, path):
+    # Writes the secret to path only when the file is missing or the secret changed
+    value = get_secret(secret_name)
+    digest = _digest(value)
+    with _lock:
+        if _written_files.get(path) == digest and os.path.exists(path):
+            return path
+        #created 0600 so the private key is never readable by others, fchmod covers an existing file
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as file:
+            file.write(value)
+        _written_files[path] = digest
+    return path
+
+
+def invalidate(secret_name=None):
+    # Forgets one cached secret (or all of them), e.g. after an authentication error
+    with _lock:
+        if secret_name:
+            _secrets.pop(secret_name, None)
+        else:
+            _secrets.clear()
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
@@ -1,60 +1,236 @@
 #!/usr/bin/env python
 #-*- encoding: utf-8 -*-
 
-import pysftp as sftp
-import boto3
-import botocore
+import argparse
+import botocore.exceptions
+import hashlib
 import json
 import os
-import urllib
+import paramiko
+import threading
+import time
 
-def get_secret_pem():
-    secret_name=os.environ['pem_secret_name']
-    client = boto3.client(service_name= 'secretsmanager',region_name= 'us-east-1')
-    credentials = client.get_secret_value(SecretId=secret_name)
-    return credentials['SecretString']
+import aws_clients
+import batch
+import s3_stream
+import secret_cache
+import sftp_pool
 
 def S3_download_file(bucket_name,bucket_key_name,local_file):
     
-    session = boto3.session.Session(region_name='us-east-1')
-    s3 = session.resource('s3')
+    s3 = aws_clients.get_client('s3')
     try:
-        s3.Bucket(bucket_name).download_file(bucket_key_name, '/tmp/' f'{local_file}') 
+        s3.download_file(bucket_name, bucket_key_name, '/tmp/' f'{local_file}')
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             print("The object does not exist.")
         else:
             raise
 
-def lambda_handler(event,context):
+PEM_PATH = '/tmp/idemia.pem'
+#Tail of the remote partial file compared with the object before resuming
+CHECK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 64 * 1024 * 1024
+MAX_ATTEMPTS = 5
 
-    sftp_user_name = os.environ['sftp_user_name'] 
-    sftp_url = os.environ['sftp_url']
+_metrics = {'uploads': 0, 'resumes': 0, 'restarts': 0, 'bytes_skipped': 0, 'bytes_uploaded': 0}
+_metrics_lock = threading.Lock()
+#remote file -> ETag of the object version being written to it, a partial file of another version is rewritten
+_written_etags = {}
 
-    print("Received event: " + json.dumps(event, indent=2))
-    bucket_name = event['Records'][0]['s3']['bucket']['name']
-    bucket_key_name = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+
+def open_connection():
+    # Pooled connection to the partner server, see sftp_pool.connection
+    #Creating pem file, only rewritten on cold start or when the secret was rotated
+    secret_cache.write_secret_file(os.environ['pem_secret_name'], PEM_PATH)
+    return sftp_pool.connection(host=os.environ['sftp_url'], username=os.environ['sftp_user_name'],
+                                private_key=PEM_PATH, port=22)
+
+
+def stage_object(s, bucket_name, bucket_key_name):
+    # Legacy mode: downloads the object to /tmp and uploads the file
     local_file = bucket_key_name.split("/")[-1]
- 
+
     print(f"Downloading file from bucket: {bucket_name} and key: {bucket_key_name}")
     S3_download_file(bucket_name,bucket_key_name,local_file)
-    
-    #Setting options for sftp connection
-    cnopts = sftp.CnOpts()
-    cnopts.hostkeys = None
-    #Creating pem file
-    with open('/tmp/idemia.pem', 'w') as file:
-        file.write(f"{get_secret_pem()}")
-    #Atempting sftp connection
-    try:
-        s = sftp.Connection(host=f'{sftp_url}', username=f'{sftp_user_name}', port=22, private_key='/tmp/idemia.pem', cnopts=cnopts)
-    except Exception as e:
-        print (e)
     try:
         s.put(f'/tmp/{local_file}', preserve_mtime=True)
         print ("file uploaded")
-    except Exception as e:
-        print (e)
+    finally:
+        print(f"Deleting local file: {local_file}")
+        if os.path.exists(f'/tmp/{local_file}'):
+            os.remove(f'/tmp/{local_file}')
+
+
+def remote_size(s, remote_file):
+    try:
+        return s.stat(remote_file).st_size
+    except IOError:
+        return 0
+
+
+def is_object_changed(e):
+    return isinstance(e, botocore.exceptions.ClientError) and e.response['Error']['Code'] in ('PreconditionFailed', '412')
+
+
+def is_retryable(e):
+    # Dropped sessions, network errors and objects overwritten during the transfer
+    # are retried, missing objects/files, permissions or configuration errors are not
+    if is_object_changed(e):
+        return True
+    if isinstance(e, (FileNotFoundError, PermissionError)):
+        return False
+    return isinstance(e, (OSError, EOFError, paramiko.SSHException, sftp_pool.sftp.ConnectionException))
+
+
+def checkpoint_matches(s, bucket_name, bucket_key_name, remote_file, offset, etag):
+    # Compares the hash of the last CHECK_SIZE bytes of the remote partial file
+    # with the same range of the S3 object version etag
+    start = max(0, offset - CHECK_SIZE)
+    with s.open(remote_file, 'rb') as f:
+        f.seek(start)
+        remote = hashlib.sha256(f.read(offset - start)).hexdigest()
+    s3 = aws_clients.get_client('s3')
+    try:
+        body = s3.get_object(Bucket=bucket_name, Key=bucket_key_name, Range=f'bytes={start}-{offset - 1}',
+                             IfMatch=etag)['Body']
+    except botocore.exceptions.ClientError as e:
+        if is_object_changed(e):
+            return False
+        raise
+    return remote == hashlib.sha256(body.read()).hexdigest()
+
+
+def _count(**counters):
+    with _metrics_lock:
+        for name, value in counters.items():
+            _metrics[name] += value
+
+
+def stream_object(s, bucket_name, bucket_key_name, buffer_size=s3_stream.BUFFER_SIZE):
+    # Streams the S3 body into the remote file, the download overlaps with the
+    # upload and the file size is not limited by /tmp. A partial remote file left
+    # by a dropped session is resumed from its size when its checkpoint hash
+    # matches the object, and rewritten otherwise. Every read is pinned to the
+    # ETag of head_object, so an object overwritten meanwhile is never spliced
+    # into a partial file written from its previous version. Returns the transfer stats.
+    remote_file = bucket_key_name.split("/")[-1]
+    head = aws_clients.get_client('s3').head_object(Bucket=bucket_name, Key=bucket_key_name)
+    size, etag = head['ContentLength'], head['ETag']
+    offset = remote_size(s, remote_file)
+    with _metrics_lock:
+        written_etag = _written_etags.get(remote_file)
+    if offset and (offset > size or written_etag not in (None, etag)
+                   or not checkpoint_matches(s, bucket_name, bucket_key_name, remote_file, offset, etag)):
+        print(f"Remote file {remote_file} does not match the object, restarting from byte 0")
+        _count(restarts=1)
+        offset = 0
+    elif offset == size and size:
+        print(f"Remote file {remote_file} is already complete")
+        return {'bytes': 0, 'seconds': 0.0, 'ttfb': None, 'mb_per_s': 0.0}
+    elif offset:
+        print(f"Resuming {remote_file} at byte {offset} of {size}")
+        _count(resumes=1, bytes_skipped=offset)
+
+    print(f"Streaming file from bucket: {bucket_name} and key: {bucket_key_name}")
+    reader = s3_stream.S3Reader(bucket_name, bucket_key_name, offset=offset, buffer_size=buffer_size, if_match=etag)
+    with _metrics_lock:
+        _written_etags[remote_file] = etag
+    transferred = offset
+    next_report = offset + PROGRESS_INTERVAL
+    try:
+        with s.open(remote_file, 'r+b' if offset else 'wb') as f:
+            f.set_pipelined(True)
+            f.seek(offset)
+            while True:
+                chunk = reader.read(s3_stream.READ_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                transferred += len(chunk)
+                _count(bytes_uploaded=len(chunk))
+                if transferred >= next_report:
+                    print(f"{remote_file}: {transferred} of {size} bytes ({transferred * 100 // size}%)")
+                    next_report += PROGRESS_INTERVAL
+    finally:
+        reader.close()
+    if remote_size(s, remote_file) != size:
+        raise IOError(f"Remote file {remote_file} has {remote_size(s, remote_file)} bytes, expected {size}")
+    _count(uploads=1)
+    stats = reader.stats()
+    print(f"file uploaded: {stats['bytes']} bytes in {stats['seconds']:.2f}s ({stats['mb_per_s']:.1f} MB/s), "
+          f"time to first byte {stats['ttfb'] or 0:.3f}s")
+    return stats
+
+
+def upload_object(s, bucket_name, bucket_key_name):
+    if os.environ.get('streaming', 'true').lower() == 'true':
+        stream_object(s, bucket_name, bucket_key_name,
+                      buffer_size=int(os.environ.get('buffer_size', s3_stream.BUFFER_SIZE)))
+    else:
+        stage_object(s, bucket_name, bucket_key_name)
+
+
+def process_object(bucket_name, bucket_key_name):
+    #A dropped session is retried on a new connection, streaming uploads resume where they stopped
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            with open_connection() as s:
+                upload_object(s, bucket_name, bucket_key_name)
+            return
+        except Exception as e:
+            print (e)
+            if attempt == MAX_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            time.sleep(min(30, 2 ** attempt))
+
+
+def upload_objects(bucket_name, keys):
+    # Batch mode: uploads many objects over one pooled SFTP session (replaced if it
+    # drops). Returns the keys that failed.
+    failed = []
+    for key in keys:
+        try:
+            process_object(bucket_name, key)
+        except Exception as e:
+            print(f"Failed uploading {bucket_name}/{key}: {e}")
+            failed.append(key)
+    return failed
+
+
+def metrics():
+    # Returns a copy of the counters: uploads, resumes, restarts, bytes_skipped and bytes_uploaded
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+def iter_keys(bucket_name, prefix):
+    paginator = aws_clients.get_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                yield obj['Key']
+
+
+def lambda_handler(event, context):
+    
+    print("Received event: " + json.dumps(event, indent=2))
+    response = batch.process_records(event, process_object)
+    aws_clients.print_stats()
+    print(f"secret_cache: {secret_cache.stats()}")
+    sftp_pool.print_stats()
+    print(f"sftp: {metrics()}")
+    return response
+
 
-    print(f"Deleting local file: {local_file}")
-    os.remove(f'/tmp/{local_file}')
\ No newline at end of file
+if __name__ == "__main__":
+    #Month-end drops, e.g. python sftp.py --bucket my-bucket --prefix 2023-01/
+    parser = argparse.ArgumentParser(description='Uploads every object under a prefix over one SFTP session')
+    parser.add_argument("--bucket", type=str, required=True, help="Source bucket")
+    parser.add_argument("--prefix", type=str, default="", help="Source prefix to upload")
+    args = parser.parse_args()
+    failed = upload_objects(args.bucket, iter_keys(args.bucket, args.prefix))
+    sftp_pool.print_stats()
+    print(f"sftp: {metrics()}")
+    print(f"{len(failed)} objects failed")
+    raise SystemExit(1 if failed else 0)
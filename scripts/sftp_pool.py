@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
+
+# Pool of persistent pysftp connections for the S3-to-SFTP relay. Connections
+# are kept at module level, so warm invocations of the container skip the SSH
+# handshake and key exchange. A connection is checked out by one worker at a
+# time, health checked before being handed out and replaced when it is dead.
+
+import contextlib
+import threading
+import time
+
+import pysftp as sftp
+
+MAX_IDLE = 5
+#Connections idle for longer are health checked before being reused
+IDLE_CHECK_SECONDS = 30
+#Connections idle for longer are closed instead of reused (servers drop idle sessions)
+MAX_IDLE_SECONDS = 300
+CONNECT_RETRIES = 3
+
+_idle = {}
+_lock = threading.Lock()
+_stats = {'connections_created': 0, 'connections_reused': 0, 'reconnects': 0, 'connect_seconds': 0.0}
+
+
+def _connect(host, username, private_key, port):
+    cnopts = sftp.CnOpts()
+    cnopts.hostkeys = None
+    last_error = None
+    for attempt in range(CONNECT_RETRIES):
+        start = time.perf_counter()
+        try:
+            connection = sftp.Connection(host=host, username=username, port=port, private_key=private_key, cnopts=cnopts)
+        except Exception as e:
+            print(f"SFTP connection to {host} failed (attempt {attempt + 1}): {e}")
+            last_error = e
+            time.sleep(2 ** attempt)
+            continue
+        with _lock:
+            _stats['connections_created'] += 1
+            _stats['connect_seconds'] += time.perf_counter() - start
+        return connection
+    raise last_error
+
+
+def is_alive(connection):
+    # One round trip to the server, fails when the session was dropped
+    try:
+        connection.pwd
+        return True
+    except Exception:
+        return False
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def _checkout(key):
+    # Returns a healthy idle connection for key, or None
+    while True:
+        with _lock:
+            idle = _idle.get(key)
+            if not idle:
+                return None
+            connection, released = idle.pop()
+        age = time.monotonic() - released
+        if age > MAX_IDLE_SECONDS or (age > IDLE_CHECK_SECONDS and not is_alive(connection)):
+            _close(connection)
+            with _lock:
+                _stats['reconnects'] += 1
+            continue
+        with _lock:
+            _stats['connections_reused'] += 1
+        return connection
+
+
+def _release(key, connection):
+    with _lock:
+        idle = _idle.setdefault(key, [])
+        if len(idle) < MAX_IDLE:
+            idle.append((connection, time.monotonic()))
+            return
+    _close(connection)
+
+
+@contextlib.contextmanager
+def connection(host, username, private_key, port=22):
+    # Checks out a connection to host for the duration of the with block. It goes
+    # back to the pool when the block succeeds and is discarded when it raises,
+    # since the session may be broken.
+    key = (host, username, port)
+    conn = _checkout(key) or _connect(host, username, private_key, port)
+    try:
+        yield conn
+    except Exception:
+        _close(conn)
+        raise
+    _release(key, conn)
+
+
+def close_all():
+    with _lock:
+        idle = [conn for connections in _idle.values() for conn, _ in connections]
+        _idle.clear()
+    for conn in idle:
+        _close(conn)
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
+
+
+def print_stats():
+    current = stats()
+    print(f"sftp_pool: {current['connections_created']} connections created in {current['connect_seconds']:.2f}s, "
+          f"{current['connections_reused']} reuses, {current['reconnects']} dead connections replaced")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
+
+# Baseline index of the vulnerability gate. The findings of every report are
+# stored in SQLite as (report, finding key, content hash), so the next run only
+# evaluates and reports the findings that are new or whose content changed.
+# The finding key is id + package@version, the content hash covers the fields
+# the policy and the output depend on. The fingerprint of the policy the baseline
+# was accepted with is stored too, under another policy every finding is evaluated.
+
+import hashlib
+import json
+import os
+import sqlite3
+
+BASELINE_PATH = os.path.join('.vuln_baseline', 'baseline.sqlite')
+HASHED_FIELDS = ('severity', 'exploit', 'title', 'cvssScore', 'fixedIn', 'isUpgradable', 'isPatchable')
+#Several gate processes may write to the same index
+BUSY_TIMEOUT = 30
+
+
+def report_key(path):
+    # The same report typed as r.json, ./r.json or its absolute path gets the same baseline
+    return os.path.normpath(os.path.relpath(os.path.abspath(path)))
+
+
+def finding_key(item):
+    return f"{item['id']}|{item.get('packageName')}@{item.get('version')}"
+
+
+def finding_hash(item):
+    content = {field: item.get(field) for field in HASHED_FIELDS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class BaselineIndex:
+
+    def __init__(self, path=BASELINE_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS findings (
+                report TEXT, finding_key TEXT, content_hash TEXT, PRIMARY KEY (report, finding_key))''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS policies (
+                report TEXT PRIMARY KEY, policy_hash TEXT)''')
+
+    def hashes(self, report):
+        """Returns {finding key: content hash} of the baseline of a report."""
+        rows = self.connection.execute('SELECT finding_key, content_hash FROM findings WHERE report = ?',
+                                       (report,)).fetchall()
+        return dict(rows)
+
+    def policy_hash(self, report):
+        """Returns the fingerprint of the policy the baseline of a report was accepted with, or None."""
+        row = self.connection.execute('SELECT policy_hash FROM policies WHERE report = ?', (report,)).fetchone()
+        return row[0] if row else None
+
+    def store(self, report, hashes, policy_hash):
+        """Replaces the baseline of a report with {finding key: content hash} accepted under policy_hash."""
+        with self.connection:
+            self.connection.execute('DELETE FROM findings WHERE report = ?', (report,))
+            self.connection.executemany('INSERT INTO findings VALUES (?, ?, ?)',
+                                        [(report, key, digest) for key, digest in hashes.items()])
+            self.connection.execute('INSERT OR REPLACE INTO policies VALUES (?, ?)', (report, policy_hash))
+
+    def invalidate(self, report=None):
+        """Drops the baseline of a report, or all of them."""
+        with self.connection:
+            if report:
+                self.connection.execute('DELETE FROM findings WHERE report = ?', (report,))
+                self.connection.execute('DELETE FROM policies WHERE report = ?', (report,))
+            else:
+                self.connection.execute('DELETE FROM findings')
+                self.connection.execute('DELETE FROM policies')
+
+    def close(self):
+        self.connection.close()
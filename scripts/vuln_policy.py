@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
+
+# Policy engine of the vulnerability gate. A rules file is compiled once into a
+# lookup table of (severity, exploit maturity) -> rule, plus allow-lists of ids
+# and packages, so deciding a finding is a couple of dict/set lookups. Many
+# reports are evaluated in parallel in a process pool and merged into one
+# result, written as JSON and/or JUnit XML. With a baseline (vuln_baseline.py)
+# only new or changed findings are evaluated.
+#
+# Rules file (JSON):
+# {
+#   "rules": [
+#     {"name": "functional-exploit", "severities": ["low", "high", "critical"], "exploits": ["Functional"]},
+#     {"name": "critical", "min_severity": "critical"}
+#   ],
+#   "allow": {"ids": ["SNYK-JS-LODASH-567746"], "packages": ["lodash", "minimist@1.2.5"]}
+# }
+# A rule without "exploits" matches any exploit maturity.
+
+import hashlib
+import json
+import os
+import sqlite3
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import vuln_baseline
+import vuln_stream
+
+SEVERITIES = ['low', 'medium', 'high', 'critical']
+#The historical rule of the gate
+DEFAULT_RULES = {'rules': [{'name': 'functional-exploit', 'severities': ['low', 'high', 'critical'], 'exploits': ['Functional']}]}
+MAX_WORKERS = os.cpu_count() or 1
+
+
+class Policy:
+
+    def __init__(self, rules=DEFAULT_RULES):
+        #(severity, exploit) -> rule name, exploit None matches any maturity
+        self.table = {}
+        for i, rule in enumerate(rules.get('rules', [])):
+            name = rule.get('name', f'rule-{i}')
+            if 'min_severity' in rule:
+                severities = SEVERITIES[SEVERITIES.index(rule['min_severity']):]
+            else:
+                severities = rule.get('severities', SEVERITIES)
+            for severity in severities:
+                for exploit in rule.get('exploits', [None]):
+                    self.table.setdefault((severity, exploit), name)
+        allow = rules.get('allow', {})
+        self.allowed_ids = frozenset(allow.get('ids', []))
+        self.allowed_packages = frozenset(allow.get('packages', []))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def fingerprint(self):
+        # Hash of the compiled rule table and allow-lists, changes whenever a decision may change
+        content = [sorted((list(key), name) for key, name in self.table.items()),
+                   sorted(self.allowed_ids), sorted(self.allowed_packages)]
+        return hashlib.sha256(json.dumps(content, default=str).encode()).hexdigest()
+
+    def is_allowed(self, item):
+        return (item['id'] in self.allowed_ids
+                or item.get('packageName') in self.allowed_packages
+                or f"{item.get('packageName')}@{item.get('version')}" in self.allowed_packages)
+
+    def match(self, item):
+        # Returns the name of the rule matching item, or None (allow-lists are checked by is_allowed)
+        severity = item['severity']
+        return self.table.get((severity, item.get('exploit'))) or self.table.get((severity, None))
+
+
+def evaluate_report(path, policy, baseline_path=None):
+    # Streams one report and returns its result: the unique blocking findings, the
+    # number of findings read and allowed, or the error that prevented reading it.
+    # With a baseline only the findings new or changed since the baseline are
+    # evaluated, and the baseline is replaced by this report when it passes.
+    result = {'report': path, 'findings': 0, 'allowed': 0, 'blocking': [], 'error': None}
+    seen = set()
+    baseline = vuln_baseline.BaselineIndex(baseline_path) if baseline_path else None
+    report = vuln_baseline.report_key(path)
+    previous = baseline.hashes(report) if baseline else {}
+    #unchanged findings are only skipped when they were accepted under this same policy
+    same_policy = bool(baseline) and baseline.policy_hash(report) == policy.fingerprint()
+    current = {}
+    if baseline:
+        result.update({'new': 0, 'changed': 0, 'unchanged': 0, 'fixed': 0})
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for item in vuln_stream.iter_vulnerabilities(f):
+                result['findings'] += 1
+                if baseline:
+                    key = vuln_baseline.finding_key(item)
+                    if key in current:
+                        #another path to a finding already counted
+                        continue
+                    digest = current[key] = vuln_baseline.finding_hash(item)
+                    if previous.get(key) == digest:
+                        result['unchanged'] += 1
+                        if same_policy:
+                            continue
+                    else:
+                        result['changed' if key in previous else 'new'] += 1
+                if policy.is_allowed(item):
+                    result['allowed'] += 1
+                    continue
+                rule = policy.match(item)
+                if rule and item['id'] not in seen:
+                    seen.add(item['id'])
+                    result['blocking'].append({'id': item['id'], 'package': item.get('packageName'),
+                                               'version': item.get('version'), 'severity': item['severity'],
+                                               'exploit': item.get('exploit'), 'rule': rule})
+        if baseline:
+            result['fixed'] = len(previous.keys() - current.keys())
+            if not result['blocking']:
+                baseline.store(report, current, policy.fingerprint())
+    except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        if baseline:
+            baseline.close()
+    return result
+
+
+def evaluate_reports(paths, policy, max_workers=MAX_WORKERS, baseline_path=None):
+    # Evaluates the reports in a process pool and returns the merged result
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(evaluate_report, paths, [policy] * len(paths), [baseline_path] * len(paths)))
+    return {
+        'passed': not any(result['blocking'] or result['error'] for result in results),
+        'reports': len(results),
+        'blocking': sum(len(result['blocking']) for result in results),
+        'errors': sum(result['error'] is not None for result in results),
+        'results': results,
+    }
+
+
+def write_json(merged, path):
+    with open(path, 'w') as f:
+        json.dump(merged, f, indent=2)
+
+
+def write_junit(merged, path):
+    # One testsuite, one testcase per report, failed by its blocking findings
+    suite = ET.Element('testsuite', name='vulnerability-gate', tests=str(merged['reports']),
+                       failures=str(sum(bool(result['blocking']) for result in merged['results'])),
+                       errors=str(merged['errors']))
+    for result in merged['results']:
+        case = ET.SubElement(suite, 'testcase', classname='vulnerability-gate', name=result['report'])
+        if result['error']:
+            ET.SubElement(case, 'error', message=result['error'])
+        elif result['blocking']:
+            failure = ET.SubElement(case, 'failure', message=f"{len(result['blocking'])} blocking findings")
+            failure.text = '\n'.join(f"{item['id']} {item['package']}@{item['version']} {item['severity']} "
+                                     f"exploit={item['exploit']} rule={item['rule']}" for item in result['blocking'])
+    ET.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
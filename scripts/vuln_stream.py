@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#-*- encoding: utf-8 -*-
+
+# Incremental reader of scanner reports (snyk test --json). The items of every
+# "vulnerabilities" array are decoded one at a time, so memory stays at one
+# chunk plus the current item whatever the size of the report. Works for a
+# single project report and for the array of reports of --all-projects.
+
+import json
+import re
+
+CHUNK_SIZE = 1024 * 1024
+#a "vulnerabilities" key (not a string value, nor an escaped quote inside a string) opening an array
+KEY = re.compile(r'(?<!\\)"vulnerabilities"\s*:\s*\[')
+#enough of the buffer tail to hold a key split between two chunks
+KEY_TAIL = 256
+SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_vulnerabilities(stream, chunk_size=CHUNK_SIZE):
+    # The buffer is only trimmed when it is refilled, items are decoded in place
+    # from a position index so nothing is copied per item
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    while True:
+        match = KEY.search(buffer, pos)
+        if not match:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                return
+            buffer = buffer[max(pos, len(buffer) - KEY_TAIL):] + chunk
+            pos = 0
+            continue
+        pos = match.end()
+        while True:
+            pos = SEPARATORS.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == ']':
+                pos += 1
+                break
+            try:
+                if pos == len(buffer):
+                    raise ValueError('end of buffer')
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # incomplete item, read at least as much as is buffered so a big item is not re-parsed chunk by chunk
+                chunk = stream.read(max(chunk_size, len(buffer) - pos))
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
@@ -0,0 +1,106 @@
+# In-memory stand-ins for the AWS services used by the S3 Lambdas of scripts/,
+# installed in place of aws_clients.get_client by the tests.
+
+import hashlib
+import io
+import threading
+
+import botocore.exceptions
+
+
+def client_error(code, operation):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeS3:
+    # Objects, multipart uploads and the calls that matter to the tests
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.completed = []
+        self.aborted = []
+        self.fail_part = None
+        self.part_calls = 0
+        self.lock = threading.Lock()
+
+    def put(self, bucket, key, data):
+        self.objects[(bucket, key)] = data
+
+    def etag(self, bucket, key):
+        return '"' + hashlib.md5(self.objects[(bucket, key)]).hexdigest() + '"'
+
+    def _object(self, bucket, key, operation):
+        if (bucket, key) not in self.objects:
+            raise client_error('NoSuchKey', operation)
+        return self.objects[(bucket, key)]
+
+    def head_object(self, Bucket, Key):
+        data = self._object(Bucket, Key, 'HeadObject')
+        return {'ContentLength': len(data), 'ETag': self.etag(Bucket, Key)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        data = self._object(Bucket, Key, 'GetObject')
+        if IfMatch and IfMatch != self.etag(Bucket, Key):
+            raise client_error('PreconditionFailed', 'GetObject')
+        if Range:
+            first, last = Range[len('bytes='):].split('-')
+            data = data[int(first):int(last) + 1 if last else None]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'ETag': self.etag(Bucket, Key)}
+
+    def put_object(self, Bucket, Key, Body=b''):
+        self.put(Bucket, Key, Body if isinstance(Body, bytes) else Body.read())
+
+    def create_multipart_upload(self, Bucket, Key):
+        with self.lock:
+            upload_id = f'upload-{len(self.uploads) + 1}'
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.part_calls += 1
+        if PartNumber == self.fail_part:
+            raise client_error('InternalError', 'UploadPart')
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        assert numbers == sorted(parts), 'every uploaded part is completed, in order'
+        self.put(Bucket, Key, b''.join(parts[number] for number in numbers))
+        self.completed.append((Bucket, Key, len(numbers)))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted.append((Bucket, Key))
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return FakePaginator(self)
+
+
+class FakePaginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix=''):
+        keys = sorted(key for bucket, key in self.s3.objects if bucket == Bucket and key.startswith(Prefix))
+        yield {'Contents': [{'Key': key, 'Size': len(self.s3.objects[(Bucket, key)])} for key in keys]}
+
+
+class FakeSecretsManager:
+    def __init__(self, secrets):
+        self.secrets = secrets
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        return {'SecretString': self.secrets[SecretId]}
+
+
+def install(monkeypatch, **clients):
+    # Routes aws_clients.get_client(service) to clients[service]
+    import aws_clients
+    monkeypatch.setattr(aws_clients, 'get_client', lambda service, *args, **kwargs: clients[service])
@@ -0,0 +1,133 @@
+# Streaming encryption and decryption of the S3 Lambdas (encrypt.py, decrypt.py,
+# s3_stream.pipe_s3_object) against an in-memory S3 and throwaway GPG keyrings.
+
+import os
+import shutil
+import tempfile
+
+import gnupg
+import pytest
+
+import fakes
+
+if not shutil.which('gpg'):
+    pytest.skip('gpg binary not installed', allow_module_level=True)
+
+import decrypt
+import encrypt
+import s3_stream
+import secret_cache
+
+BUCKET = 'provider-files'
+PART_SIZE = 256 * 1024
+
+
+def keyring():
+    #short path, gpg-agent sockets live in the home and are limited to ~100 characters
+    return tempfile.mkdtemp(prefix='gpg-', dir='/tmp')
+
+
+@pytest.fixture(scope='module')
+def key():
+    # Generates a key without passphrase, returns (fingerprint, armored public + secret key)
+    home = keyring()
+    try:
+        gpg = gnupg.GPG(gnupghome=home)
+        generated = gpg.gen_key(gpg.gen_key_input(key_type='EDDSA', key_curve='ed25519', subkey_type='ECDH',
+                                                  subkey_curve='cv25519', name_email='lambda@example.com',
+                                                  no_protection=True))
+        assert generated.fingerprint, generated.stderr
+        armored = gpg.export_keys(generated.fingerprint) + gpg.export_keys(generated.fingerprint, secret=True,
+                                                                          expect_passphrase=False)
+        yield generated.fingerprint, armored
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+@pytest.fixture
+def s3(monkeypatch, key):
+    # Fake S3 and Secrets Manager, an empty keyring per Lambda, keys imported from the secret
+    fingerprint, armored = key
+    s3 = fakes.FakeS3()
+    fakes.install(monkeypatch, s3=s3, secretsmanager=fakes.FakeSecretsManager({'gpg-key': armored}))
+    homes = [keyring(), keyring()]
+    monkeypatch.setattr(encrypt, '_gpg', gnupg.GPG(gnupghome=homes[0]))
+    monkeypatch.setattr(decrypt, '_gpg', gnupg.GPG(gnupghome=homes[1]))
+    monkeypatch.setattr(secret_cache, '_secrets', {})
+    monkeypatch.setattr(secret_cache, '_imported_keys', {})
+    for name, value in {'secret_name': 'gpg-key', 'gpg_key_id': fingerprint, 'streaming': 'true',
+                        'part_size': str(PART_SIZE)}.items():
+        monkeypatch.setenv(name, value)
+    yield s3
+    for home in homes:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def test_round_trip(s3, monkeypatch):
+    plaintext = os.urandom(3 * PART_SIZE + 1234)
+    s3.put(BUCKET, 'in/report.2023.01.csv', plaintext)
+
+    monkeypatch.setenv('dst_prefix', 'encrypted')
+    encrypt.process_object(BUCKET, 'in/report.2023.01.csv')
+    ciphertext = s3.objects[(BUCKET, 'encrypted/report.txt.gpg')]
+    assert ciphertext != plaintext
+
+    s3.put(BUCKET, 'in/report.2023.01.csv.gpg', ciphertext)
+    monkeypatch.setenv('dst_prefix', 'decrypted')
+    decrypt.process_object(BUCKET, 'in/report.2023.01.csv.gpg')
+
+    assert s3.objects[(BUCKET, 'decrypted/report.2023.01.csv')] == plaintext
+    assert s3.completed[-1] == (BUCKET, 'decrypted/report.2023.01.csv', 4)
+    assert not s3.uploads and not s3.aborted
+
+
+def test_empty_object(s3):
+    s3.put(BUCKET, 'in/empty.csv', b'')
+    encrypt.import_key()
+    encrypt.S3_encrypt_stream(BUCKET, 'in/empty.csv', 'out/empty.csv.gpg')
+    s3.put(BUCKET, 'in/empty.csv.gpg', s3.objects[(BUCKET, 'out/empty.csv.gpg')])
+    decrypt.import_key()
+    stats = decrypt.S3_decrypt_stream(BUCKET, 'in/empty.csv.gpg', 'out/empty.csv')
+    assert s3.objects[(BUCKET, 'out/empty.csv')] == b''
+    assert stats['parts'] == 1
+
+
+def test_gpg_failure_aborts_the_upload(s3):
+    s3.put(BUCKET, 'in/broken.csv.gpg', b'not an openpgp message' * 1000)
+    decrypt.import_key()
+    with pytest.raises(RuntimeError, match='exited with'):
+        decrypt.S3_decrypt_stream(BUCKET, 'in/broken.csv.gpg', 'out/broken.csv')
+    assert s3.aborted == [(BUCKET, 'out/broken.csv')]
+    assert not s3.uploads and (BUCKET, 'out/broken.csv') not in s3.objects
+
+
+def test_missing_command_aborts_the_upload(s3):
+    s3.put(BUCKET, 'in/report.csv', b'data')
+    with pytest.raises(FileNotFoundError):
+        s3_stream.pipe_s3_object(['/nonexistent/gpg', '--encrypt'], BUCKET, 'in/report.csv', BUCKET, 'out/report.csv.gpg')
+    assert s3.aborted == [(BUCKET, 'out/report.csv.gpg')]
+    assert not s3.uploads
+
+
+def test_failed_part_aborts_before_the_end_of_the_object(s3):
+    size = 40 * PART_SIZE
+    s3.put(BUCKET, 'in/big.bin', os.urandom(size))
+    s3.fail_part = 1
+    with pytest.raises(Exception, match='InternalError'):
+        s3_stream.pipe_s3_object(['cat'], BUCKET, 'in/big.bin', BUCKET, 'out/big.bin', part_size=PART_SIZE,
+                                 max_in_flight=2)
+    assert s3.aborted == [(BUCKET, 'out/big.bin')]
+    #the failure is raised by the next write(), not after the last part was submitted
+    assert s3.part_calls < 10
+    assert not s3.uploads and (BUCKET, 'out/big.bin') not in s3.objects
+
+
+@pytest.mark.parametrize('file_name, expected', [
+    ('report.2023.01.csv.gpg', 'report.2023.01.csv'),
+    ('archive.tar.gz.pgp', 'archive.tar.gz'),
+    ('keys.v2.ASC', 'keys.v2'),
+    ('data.2023.01.csv', 'data.2023.01.csv'),
+    ('noextension', 'noextension'),
+])
+def test_plain_name(file_name, expected):
+    assert decrypt.plain_name(file_name) == expected
@@ -0,0 +1,259 @@
+# SFTP relay (sftp.py) and its connection pool (sftp_pool.py) against an
+# in-memory S3 and a stand-in SFTP server that serves a local directory.
+
+import os
+
+import pytest
+
+import fakes
+
+import secret_cache
+import sftp
+import sftp_pool
+
+BUCKET = 'partner-drop'
+
+
+class SFTPServer:
+    # Local directory served through FakeConnection sessions. drop_after makes the
+    # next session fail after writing that many bytes, like a dropped SSH session.
+    def __init__(self, root):
+        self.root = root
+        self.sessions = []
+        self.drop_after = None
+
+
+class RemoteFile:
+    def __init__(self, session, path, mode):
+        self.session = session
+        self.file = open(path, mode)
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def seek(self, offset):
+        self.file.seek(offset)
+
+    def read(self, size=-1):
+        self.session.check()
+        return self.file.read(size)
+
+    def write(self, data):
+        self.session.check()
+        if self.session.drop_after is not None and self.session.written + len(data) > self.session.drop_after:
+            #the bytes before the drop reached the server
+            self.file.write(data[:self.session.drop_after - self.session.written])
+            self.session.written = self.session.drop_after
+            self.session.alive = False
+            raise EOFError('session dropped')
+        self.session.written += len(data)
+        self.file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+
+class FakeConnection:
+    # Stands in for pysftp.Connection, with the calls sftp.py and sftp_pool.py make
+    def __init__(self, server, host, username, port, private_key, cnopts):
+        self.server = server
+        self.private_key = private_key
+        self.alive = True
+        self.closed = False
+        self.pwd_calls = 0
+        self.written = 0
+        self.drop_after, server.drop_after = server.drop_after, None
+        server.sessions.append(self)
+
+    def check(self):
+        if self.closed or not self.alive:
+            raise EOFError('session dropped')
+
+    def _path(self, remote_file):
+        return os.path.join(self.server.root, remote_file)
+
+    @property
+    def pwd(self):
+        self.pwd_calls += 1
+        self.check()
+        return '/'
+
+    def stat(self, remote_file):
+        self.check()
+        return os.stat(self._path(remote_file))
+
+    def open(self, remote_file, mode='r'):
+        self.check()
+        return RemoteFile(self, self._path(remote_file), mode)
+
+    def put(self, local_file, preserve_mtime=False):
+        self.check()
+        with open(local_file, 'rb') as f, open(self._path(os.path.basename(local_file)), 'wb') as remote:
+            remote.write(f.read())
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock:
+    # Replaces the time module of sftp_pool, idle ages are advanced by hand
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(sftp_pool, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch, clock):
+    server = SFTPServer(str(tmp_path / 'remote'))
+    os.makedirs(server.root)
+    monkeypatch.setattr(sftp_pool.sftp, 'Connection', lambda **kwargs: FakeConnection(server, **kwargs))
+    monkeypatch.setattr(sftp_pool, '_idle', {})
+    monkeypatch.setattr(sftp_pool, '_stats', {'connections_created': 0, 'connections_reused': 0, 'reconnects': 0,
+                                              'connect_seconds': 0.0})
+    yield server
+    sftp_pool.close_all()
+
+
+@pytest.fixture
+def s3(server, tmp_path, monkeypatch):
+    # Fake S3 and Secrets Manager, the PEM is written under tmp_path
+    s3 = fakes.FakeS3()
+    fakes.install(monkeypatch, s3=s3, secretsmanager=fakes.FakeSecretsManager({'partner-pem': 'PRIVATE KEY'}))
+    monkeypatch.setattr(secret_cache, '_secrets', {})
+    monkeypatch.setattr(secret_cache, '_written_files', {})
+    monkeypatch.setattr(sftp, 'PEM_PATH', str(tmp_path / 'partner.pem'))
+    monkeypatch.setattr(sftp, '_written_etags', {})
+    monkeypatch.setattr(sftp, '_metrics', {name: 0 for name in sftp._metrics})
+    monkeypatch.setattr(sftp.time, 'sleep', lambda seconds: None)
+    for name, value in {'pem_secret_name': 'partner-pem', 'sftp_url': 'sftp.partner.example',
+                        'sftp_user_name': 'uploader', 'streaming': 'true'}.items():
+        monkeypatch.setenv(name, value)
+    return s3
+
+
+def remote(server, name):
+    with open(os.path.join(server.root, name), 'rb') as f:
+        return f.read()
+
+
+def test_reuse(server):
+    with sftp_pool.connection('host', 'user', 'key') as first:
+        pass
+    with sftp_pool.connection('host', 'user', 'key') as second:
+        pass
+    assert second is first
+    assert first.pwd_calls == 0, 'a connection idle for less than IDLE_CHECK_SECONDS is not health checked'
+    with sftp_pool.connection('other-host', 'user', 'key') as other:
+        pass
+    assert other is not first, 'connections are pooled per host'
+    stats = sftp_pool.stats()
+    assert stats['connections_created'] == 2 and stats['connections_reused'] == 1
+
+
+def test_idle_health_check(server, clock):
+    with sftp_pool.connection('host', 'user', 'key') as first:
+        pass
+    clock.now += sftp_pool.IDLE_CHECK_SECONDS + 1
+    with sftp_pool.connection('host', 'user', 'key') as second:
+        pass
+    assert second is first and first.pwd_calls == 1, 'a live idle connection is health checked and reused'
+
+    first.alive = False
+    clock.now += sftp_pool.IDLE_CHECK_SECONDS + 1
+    with sftp_pool.connection('host', 'user', 'key') as third:
+        pass
+    assert third is not first and first.closed, 'a dead idle connection is closed and replaced'
+    assert sftp_pool.stats()['reconnects'] == 1
+
+    clock.now += sftp_pool.MAX_IDLE_SECONDS + 1
+    with sftp_pool.connection('host', 'user', 'key') as fourth:
+        pass
+    assert fourth is not third and third.closed
+    assert third.pwd_calls == 0, 'an expired connection is closed without a round trip'
+
+
+def test_broken_session_is_discarded(server):
+    with pytest.raises(EOFError):
+        with sftp_pool.connection('host', 'user', 'key') as broken:
+            raise EOFError('transfer failed')
+    assert broken.closed
+    with sftp_pool.connection('host', 'user', 'key') as fresh:
+        pass
+    assert fresh is not broken
+
+
+def test_max_idle(server):
+    blocks = [sftp_pool.connection('host', 'user', 'key') for _ in range(sftp_pool.MAX_IDLE + 2)]
+    connections = [block.__enter__() for block in blocks]
+    for block in blocks:
+        block.__exit__(None, None, None)
+    assert len(sftp_pool._idle[('host', 'user', 22)]) == sftp_pool.MAX_IDLE
+    assert sum(connection.closed for connection in connections) == 2
+
+
+def test_batch_mode_uses_one_session(server, s3):
+    objects = {f'2023-01/statement-{i}.csv': os.urandom(100_000 + i) for i in range(5)}
+    for key, data in objects.items():
+        s3.put(BUCKET, key, data)
+
+    failed = sftp.upload_objects(BUCKET, sftp.iter_keys(BUCKET, '2023-01/'))
+
+    assert failed == []
+    for key, data in objects.items():
+        assert remote(server, key.split('/')[-1]) == data
+    assert len(server.sessions) == 1, 'every object goes over the same pooled session'
+    assert sftp_pool.stats()['connections_reused'] == len(objects) - 1
+    assert sftp.metrics()['uploads'] == len(objects)
+    assert os.stat(sftp.PEM_PATH).st_mode & 0o777 == 0o600
+
+
+def test_batch_mode_reports_failed_keys(server, s3):
+    s3.put(BUCKET, '2023-01/ok.csv', b'ok')
+    failed = sftp.upload_objects(BUCKET, ['2023-01/missing.csv', '2023-01/ok.csv'])
+    assert failed == ['2023-01/missing.csv']
+    assert remote(server, 'ok.csv') == b'ok'
+
+
+def test_dropped_session_resumes_on_a_new_connection(server, s3, monkeypatch):
+    monkeypatch.setattr(sftp, 'CHECK_SIZE', 4096)
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    s3.put(BUCKET, 'drop/large.bin', data)
+    server.drop_after = 2 * 1024 * 1024
+
+    sftp.process_object(BUCKET, 'drop/large.bin')
+
+    assert remote(server, 'large.bin') == data
+    assert len(server.sessions) == 2 and server.sessions[0].closed, 'the dropped session is not reused'
+    assert sftp.metrics()['resumes'] == 1 and sftp.metrics()['bytes_skipped'] == 2 * 1024 * 1024
+
+
+def test_overwritten_object_restarts_from_zero(server, s3):
+    s3.put(BUCKET, 'drop/report.csv', b'a' * 10_000)
+    server.drop_after = 4096
+    with pytest.raises(EOFError):
+        with sftp.open_connection() as s:
+            sftp.upload_object(s, BUCKET, 'drop/report.csv')
+    s3.put(BUCKET, 'drop/report.csv', b'b' * 12_000)
+
+    sftp.process_object(BUCKET, 'drop/report.csv')
+
+    assert remote(server, 'report.csv') == b'b' * 12_000
+    assert sftp.metrics()['restarts'] == 1